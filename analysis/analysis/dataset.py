@@ -0,0 +1,94 @@
+"""
+dataset.py
+
+One row per conference item with its authors and keywords as list columns, built from a
+five-file parquet directory (see export.py) with lazy polars joins.
+
+The joined table is cached next to the parquet files as an uncompressed Arrow IPC file
+named after a fingerprint of its inputs, so it is rebuilt only when one of them changes
+and otherwise memory-mapped straight back in:
+
+    from analysis.dataset import load_items
+    df = load_items("../data/ICML2022")
+"""
+import hashlib
+import logging
+import typing as ty
+from pathlib import Path
+
+import polars as pl
+
+
+logger = logging.getLogger(__name__)
+
+SOURCE_FILES = (
+    "items.parquet",
+    "authors.parquet",
+    "keywords.parquet",
+    "author_item_relations.parquet",
+    "keyword_item_relations.parquet",
+)
+CACHE_DIR = ".cache"
+
+
+def fingerprint(directory: Path) -> str:
+    """Hash of the name, size and mtime of each source file"""
+    h = hashlib.sha1()
+    for name in SOURCE_FILES:
+        stat = (directory / name).stat()
+        h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+
+def build_items(directory: Path) -> pl.LazyFrame:
+    items = pl.scan_parquet(directory / "items.parquet")
+    authors = (
+        pl.scan_parquet(directory / "author_item_relations.parquet")
+        .join(pl.scan_parquet(directory / "authors.parquet"), left_on="author_id", right_on="id")
+        .groupby("confitem_id")
+        .agg(pl.col("name").alias("authors"))
+    )
+    keywords = (
+        pl.scan_parquet(directory / "keyword_item_relations.parquet")
+        .join(pl.scan_parquet(directory / "keywords.parquet"), left_on="keyword_id", right_on="id")
+        .with_columns(pl.col("value").str.strip())
+        .groupby("confitem_id")
+        .agg([pl.col("value").alias("keywords"), pl.col("type").alias("keyword_types")])
+    )
+    return (
+        items
+        .join(authors, left_on="id", right_on="confitem_id", how="left")
+        .join(keywords, left_on="id", right_on="confitem_id", how="left")
+    )
+
+
+def load_items(directory: ty.Union[str, Path], use_cache: bool = True) -> pl.DataFrame:
+    """
+    Denormalized items of one parquet directory, with list-typed `authors`, `keywords`
+    and `keyword_types` columns (null where an item has none)
+    """
+    directory = Path(directory)
+    if not use_cache:
+        return build_items(directory).collect()
+    cache_dir = directory / CACHE_DIR
+    path = cache_dir / f"items-{fingerprint(directory)}.arrow"
+    if path.exists():
+        logger.info(f"Reading cached items from {path}")
+        return pl.read_ipc(path, memory_map=True)
+    logger.info(f"Building denormalized items for {directory}")
+    df = build_items(directory).collect()
+    cache_dir.mkdir(exist_ok=True)
+    # drop caches of earlier versions of the inputs
+    for stale in cache_dir.glob("items-*.arrow"):
+        stale.unlink()
+    tmp = path.with_suffix(".tmp")
+    # uncompressed so that it can be memory-mapped
+    df.write_ipc(tmp, compression="uncompressed")
+    tmp.replace(path)
+    return df
+
+
+def load_all_items(data_dir: ty.Union[str, Path], use_cache: bool = True) -> pl.DataFrame:
+    """Denormalized items of every parquet directory under `data_dir`, stacked"""
+    directories = sorted(p.parent for p in Path(data_dir).rglob("items.parquet") if CACHE_DIR not in p.parts)
+    return pl.concat([load_items(d, use_cache=use_cache) for d in directories], how="diagonal")
@@ -18,15 +18,25 @@ trap_interrupt() {
 # Set up the trap to catch keyboard interrupt signal
 trap trap_interrupt INT
 
-# Run the command in an infinite loop
+# Run the crawler until it finishes. Progress is checkpointed under .crawlstate/ (see
+# scraper/crawlstate.py), so after a failure it is restarted and resumes where it stopped
+max_restarts=${MAX_RESTARTS:-20}
+backoff=5
+restarts=0
 while true; do
   echo "Running the $crawler_name crawler..."
   $command
   status=$?
-  if [ $status -ne 0 ]; then
-    echo "Crawler failed with exit status $status. Restarting..."
-  else
-    echo "Crawler finished successfully. Restarting..."
+  if [ $status -eq 0 ]; then
+    echo "Crawler finished successfully."
+    exit 0
   fi
-  sleep 1
+  restarts=$((restarts + 1))
+  if [ $restarts -gt $max_restarts ]; then
+    echo "Crawler failed $restarts times, giving up."
+    exit $status
+  fi
+  echo "Crawler failed with exit status $status. Restarting in ${backoff}s ($restarts/$max_restarts)..."
+  sleep $backoff
+  backoff=$((backoff * 2 > 300 ? 300 : backoff * 2))
 done
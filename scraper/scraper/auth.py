@@ -0,0 +1,111 @@
+"""
+auth.py
+
+Encrypted on-disk cache of a Playwright storage state (cookies and local storage) after
+logging in, so that restarts and new browser contexts can start from a logged in session
+instead of going through the login form again.
+
+The file is encrypted with Fernet, either with an explicit key (STORAGE_STATE_KEY, as
+generated by `Fernet.generate_key()`) or with one derived from the account password,
+and is rejected once it is older than its maximum age or its session cookies expired.
+"""
+import base64
+import json
+import logging
+import os
+import time
+import typing as ty
+from pathlib import Path
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+
+logger = logging.getLogger(__name__)
+
+SALT_SIZE = 16
+KDF_ITERATIONS = 390_000
+
+
+def derive_key(password: str, salt: bytes) -> bytes:
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS)
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+
+def cookies_expired(state: ty.Dict[str, ty.Any], now: ty.Optional[float] = None) -> bool:
+    """Whether every cookie with an expiry date has expired (session cookies have -1)"""
+    now = time.time() if now is None else now
+    expiries = [c["expires"] for c in state.get("cookies", []) if c.get("expires", -1) > 0]
+    return bool(expiries) and max(expiries) < now
+
+
+class StorageStateCache:
+    """
+    Storage state at `path`, encrypted with `key` if given or else with a key derived
+    from `password` and a random salt stored in front of the token.
+    """
+
+    def __init__(self, path: ty.Union[str, Path], key: ty.Optional[str] = None, password: ty.Optional[str] = None,
+                 max_age: float = 12 * 3600):
+        if key is None and password is None:
+            raise ValueError("either a key or a password is needed to encrypt the storage state")
+        self.path = Path(path)
+        self.key = key
+        self.password = password
+        self.max_age = max_age
+
+    def fernet(self, salt: bytes) -> Fernet:
+        return Fernet(self.key if self.key is not None else derive_key(self.password, salt))
+
+    def load(self) -> ty.Optional[ty.Dict[str, ty.Any]]:
+        """The cached storage state, or None if there is none or it can't be used anymore"""
+        if not self.path.exists():
+            return None
+        data = self.path.read_bytes()
+        salt, token = data[:SALT_SIZE], data[SALT_SIZE:]
+        try:
+            # ttl checks the timestamp the token was encrypted at
+            state = json.loads(self.fernet(salt).decrypt(token, ttl=int(self.max_age)))
+        except InvalidToken:
+            logger.info(f"Cached storage state {self.path} expired or unreadable, discarding it")
+            self.invalidate()
+            return None
+        if cookies_expired(state):
+            logger.info(f"Cookies of cached storage state {self.path} expired, discarding it")
+            self.invalidate()
+            return None
+        logger.info(f"Using cached storage state {self.path}")
+        return state
+
+    def save(self, state: ty.Dict[str, ty.Any]):
+        salt = os.urandom(SALT_SIZE)
+        token = self.fernet(salt).encrypt(json.dumps(state).encode())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        # readable by the owner only, written next to the target and renamed
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(salt + token)
+        tmp.replace(self.path)
+        logger.info(f"Saved storage state to {self.path}")
+
+    def invalidate(self):
+        self.path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    state = {"cookies": [{"name": "session", "value": "s3cr3t-session-id", "expires": time.time() + 3600}], "origins": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kwargs in (dict(password="hunter2"), dict(key=Fernet.generate_key().decode())):
+            cache = StorageStateCache(Path(tmp) / "state", **kwargs)
+            cache.save(state)
+            assert state["cookies"][0]["value"].encode() not in cache.path.read_bytes()
+            assert cache.load() == state
+        assert StorageStateCache(cache.path, password="wrong").load() is None
+        assert not cache.path.exists()
+        cache.save({"cookies": [{"name": "session", "value": "x", "expires": time.time() - 1}]})
+        assert cache.load() is None
@@ -0,0 +1,175 @@
+"""
+bulkload.py
+
+Bulk (re)load of conference data from parquet snapshots, for backfills and re-imports
+where going through the ORM is far too slow.
+
+Expects the five-file layout written by analysis/notebooks/dump_db_to_parquet.ipynb:
+items.parquet, authors.parquet, keywords.parquet, author_item_relations.parquet and
+keyword_item_relations.parquet. Each file is streamed into a temporary staging table with
+COPY FROM STDIN, then authors/keywords/items are resolved against their natural keys
+and the link rows inserted with set-based SQL, all in one transaction per directory.
+
+    python -m scraper.bulkload ../analysis/data/ICML2022 ../analysis/data/NeurIPS2022
+"""
+import argparse
+import io
+import logging
+import time
+import typing as ty
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from scraper.db import create_db_and_tables, get_engine
+
+
+logger = logging.getLogger(__name__)
+
+
+# staging table -> (parquet file, columns in COPY order with their pg types)
+STAGING_TABLES: ty.Dict[str, ty.Tuple[str, ty.Dict[str, str]]] = {
+    "stage_item": ("items.parquet", {
+        "id": "integer",
+        "url": "text",
+        "title": "text",
+        "item_type": "text",
+        "conference": "text",
+        "year": "integer",
+        "abstract": "text",
+        "paper_url": "text",
+        "openreview_url": "text",
+        "poster_url": "text",
+        "slides_url": "text",
+    }),
+    "stage_author": ("authors.parquet", {"id": "integer", "name": "text"}),
+    "stage_keyword": ("keywords.parquet", {"id": "integer", "type": "text", "value": "text"}),
+    "stage_author_link": ("author_item_relations.parquet", {"author_id": "integer", "confitem_id": "integer"}),
+    "stage_keyword_link": ("keyword_item_relations.parquet", {"keyword_id": "integer", "confitem_id": "integer"}),
+}
+
+ITEM_COLUMNS = [c for c in STAGING_TABLES["stage_item"][1] if c != "id"]
+
+# ids in the staging tables are the ids of the source db, everything is matched back
+# to the target db through the natural keys (url, name, (type, value))
+RESOLVE_STATEMENTS: ty.Dict[str, str] = {
+    "authors": """
+        INSERT INTO author (name)
+        SELECT DISTINCT name FROM stage_author WHERE name IS NOT NULL
+        ON CONFLICT (name) DO NOTHING
+    """,
+    "keywords": """
+        INSERT INTO keyword (type, value)
+        SELECT DISTINCT ON (coalesce(type, ''), value) nullif(type, ''), value
+        FROM stage_keyword WHERE value IS NOT NULL
+        ON CONFLICT (coalesce(type, ''), value) DO NOTHING
+    """,
+    "items": f"""
+        INSERT INTO conferenceitem ({", ".join(ITEM_COLUMNS)})
+        SELECT DISTINCT ON (url) {", ".join(ITEM_COLUMNS)}
+        FROM stage_item WHERE url IS NOT NULL ORDER BY url, id
+        ON CONFLICT (url) DO {{on_conflict}}
+    """,
+    "author_links": """
+        INSERT INTO authorpublink (author_id, confitem_id)
+        SELECT DISTINCT a.id, c.id
+        FROM stage_author_link l
+        JOIN stage_author sa ON sa.id = l.author_id
+        JOIN author a ON a.name = sa.name
+        JOIN stage_item si ON si.id = l.confitem_id
+        JOIN conferenceitem c ON c.url = si.url
+        ON CONFLICT DO NOTHING
+    """,
+    "keyword_links": """
+        INSERT INTO keywordpublink (keyword_id, confitem_id)
+        SELECT DISTINCT k.id, c.id
+        FROM stage_keyword_link l
+        JOIN stage_keyword sk ON sk.id = l.keyword_id
+        JOIN keyword k ON coalesce(k.type, '') = coalesce(sk.type, '') AND k.value = sk.value
+        JOIN stage_item si ON si.id = l.confitem_id
+        JOIN conferenceitem c ON c.url = si.url
+        ON CONFLICT DO NOTHING
+    """,
+}
+
+
+def copy_parquet(cursor, path: Path, table: str, columns: ty.Dict[str, str], batch_size: int = 50_000) -> int:
+    """
+    Stream a parquet file into `table` with COPY ... FROM STDIN (CSV), one record batch
+    at a time. Columns missing from the file are loaded as NULL.
+    """
+    if not path.exists():
+        logger.warning(f"{path} not found, {table} left empty")
+        return 0
+    parquet = pq.ParquetFile(path)
+    present = [c for c in columns if c in parquet.schema_arrow.names]
+    copy_sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    n_rows = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=present):
+        arrays = [
+            batch.column(c) if c in present else pa.nulls(batch.num_rows, pa.string())
+            for c in columns
+        ]
+        buffer = io.BytesIO()
+        # nulls are written as unquoted empty fields, which is NULL to COPY's csv format
+        pa_csv.write_csv(
+            pa.RecordBatch.from_arrays(arrays, names=list(columns)),
+            buffer,
+            pa_csv.WriteOptions(include_header=False),
+        )
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+        n_rows += batch.num_rows
+    return n_rows
+
+
+def load_directory(directory: Path, update: bool = True, batch_size: int = 50_000) -> ty.Dict[str, int]:
+    """
+    Load one five-file parquet directory in a single transaction. With `update`, items
+    already in the db (same url) are overwritten with the snapshot's fields.
+    Returns the number of rows staged and inserted per table.
+    """
+    counts = {}
+    connection = get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        for table, (filename, columns) in STAGING_TABLES.items():
+            definition = ", ".join(f"{c} {t}" for c, t in columns.items())
+            cursor.execute(f"CREATE TEMP TABLE {table} ({definition}) ON COMMIT DROP")
+            start = time.perf_counter()
+            counts[f"staged/{table}"] = copy_parquet(cursor, directory / filename, table, columns, batch_size)
+            logger.info(f"Copied {counts[f'staged/{table}']} rows into {table} in {time.perf_counter() - start:.2f}s")
+            cursor.execute(f"ANALYZE {table}")
+        on_conflict = (
+            "UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in ITEM_COLUMNS if c != "url")
+            if update else "NOTHING"
+        )
+        for name, statement in RESOLVE_STATEMENTS.items():
+            start = time.perf_counter()
+            cursor.execute(statement.format(on_conflict=on_conflict) if name == "items" else statement)
+            counts[f"inserted/{name}"] = cursor.rowcount
+            logger.info(f"Resolved {name}: {cursor.rowcount} rows in {time.perf_counter() - start:.2f}s")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directories", nargs="+", type=Path, help="directories holding the five parquet files")
+    parser.add_argument("--no-update", dest="update", action="store_false", help="keep items already in the db as they are")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="parquet rows per COPY")
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    for directory in args.directories:
+        start = time.perf_counter()
+        counts = load_directory(directory, update=args.update, batch_size=args.batch_size)
+        logger.info(f"Loaded {directory} in {time.perf_counter() - start:.2f}s: {counts}")
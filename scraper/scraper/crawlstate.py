@@ -0,0 +1,317 @@
+"""
+crawlstate.py
+
+Per-url crawl progress (scraped / failed with a retry count) in a SQLite file in WAL
+mode, mirrored in memory so that membership checks never touch the disk. Every update
+is a single-row upsert committed on its own, so a crash loses at most the url in flight
+and never corrupts what was recorded before.
+
+Spiders inheriting ResumableSpider also get their frontier (pending requests and seen
+request fingerprints) persisted in a Scrapy JOBDIR next to their crawl state, so that a
+restarted crawl carries on with the requests that were pending, skips pages already
+scraped, and only has to revisit listings that weren't finished. Listings are saved once
+fully loaded, and their pages that aren't done are queued again from the crawl state on
+start, as the frontier of a crashed run misses the requests that were in flight.
+
+A page only counts as scraped once its items are written: spiders hand their items over
+with `scraped(item, url)`, and the db pipelines report the items they committed back to
+`persisted`. Items lost in a crash (buffered, or in a failed write) leave their page to
+be scraped again by the next run. Items the pipelines give up on count as a failed attempt
+at their page, a final one for invalid and dropped items, see `failed`.
+
+Progress recorded by older versions of the AAAI spider (scraped.csv, failed.log, ...)
+can be imported with
+
+    python -m scraper.crawlstate .crawlstate/aaai_2023_crawler.sqlite --scraped scraped.csv --failed failed.log
+"""
+import argparse
+import csv
+import json
+import logging
+import sqlite3
+import time
+import typing as ty
+from collections import Counter
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
+
+
+logger = logging.getLogger(__name__)
+
+SCRAPED = "scraped"
+FAILED = "failed"
+
+
+class CrawlState:
+
+    def __init__(self, path: ty.Union[str, Path], max_retries: int = 3):
+        self.path = Path(path)
+        self.max_retries = max_retries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                kind TEXT,
+                status TEXT NOT NULL,
+                retries INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # fully loaded listings, url -> links
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                url TEXT PRIMARY KEY,
+                links TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # url -> (status, retries)
+        self.urls: ty.Dict[str, ty.Tuple[str, int]] = {
+            url: (status, retries) for url, status, retries in self.db.execute("SELECT url, status, retries FROM urls")
+        }
+        logger.info(f"Crawl state {self.path}: {self.counts()}")
+
+    @classmethod
+    def from_settings(cls, settings, name: str) -> "CrawlState":
+        return cls(
+            Path(settings.get("CRAWLSTATE_DIR", ".crawlstate")) / f"{name}.sqlite",
+            max_retries=settings.getint("CRAWLSTATE_MAX_RETRIES", 3),
+        )
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.urls
+
+    def is_scraped(self, url: str) -> bool:
+        return self.urls.get(url, (None,))[0] == SCRAPED
+
+    def is_done(self, url: str) -> bool:
+        """Scraped, or failed too often to be worth another try"""
+        status, retries = self.urls.get(url, (None, 0))
+        return status == SCRAPED or (status == FAILED and retries >= self.max_retries)
+
+    def _upsert(self, url: str, kind: ty.Optional[str], status: str, retries: int, error: ty.Optional[str] = None):
+        self.db.execute(
+            "INSERT INTO urls (url, kind, status, retries, error, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET kind = coalesce(excluded.kind, kind), status = excluded.status, "
+            "retries = excluded.retries, error = excluded.error, updated_at = excluded.updated_at",
+            (url, kind, status, retries, error, time.time()),
+        )
+        self.urls[url] = (status, retries)
+
+    def mark_scraped(self, url: str, kind: ty.Optional[str] = None):
+        self._upsert(url, kind, SCRAPED, self.urls.get(url, (None, 0))[1])
+
+    def mark_failed(self, url: str, error: ty.Optional[str] = None, kind: ty.Optional[str] = None,
+                    final: bool = False) -> int:
+        """Record a failed attempt (`final`: not worth another one), returns the number of failures so far"""
+        status, retries = self.urls.get(url, (None, 0))
+        if status == SCRAPED:
+            return retries
+        retries = max(retries + 1, self.max_retries) if final else retries + 1
+        self._upsert(url, kind, FAILED, retries, error)
+        return retries
+
+    def save_listing(self, url: str, links: ty.Sequence[ty.Any]):
+        self.db.execute(
+            "INSERT OR REPLACE INTO listings (url, links, updated_at) VALUES (?, ?, ?)",
+            (url, json.dumps(list(links)), time.time()),
+        )
+
+    def listing(self, url: str) -> ty.Optional[ty.List[ty.Any]]:
+        """Links of a listing saved by an earlier visit, None if it wasn't loaded completely"""
+        row = self.db.execute("SELECT links FROM listings WHERE url = ?", (url,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def import_urls(self, urls: ty.Iterable[str], status: str, kind: ty.Optional[str] = None) -> int:
+        n = 0
+        self.db.execute("BEGIN")
+        for url in urls:
+            if status == FAILED:
+                self.mark_failed(url, kind=kind)
+            else:
+                self.mark_scraped(url, kind=kind)
+            n += 1
+        self.db.execute("COMMIT")
+        return n
+
+    def counts(self) -> ty.Dict[str, int]:
+        return dict(Counter(status for status, _ in self.urls.values()))
+
+    def close(self):
+        self.db.close()
+
+
+class ResumableSpider:
+    """
+    Spider mixin: frontier in `<CRAWLSTATE_DIR>/<name>/job` (JOBDIR, unless one is set
+    explicitly or CRAWLSTATE_RESUME is off), and completed pages and listings in
+    `self.crawl_state`, stored as `<CRAWLSTATE_DIR>/<crawl_key>.sqlite`.
+
+    The JOBDIR is picked before the spider arguments are known, so it records the
+    crawl_key of the crawl it belongs to and a crawl with a different key refuses to
+    resume from it, until that crawl has finished.
+    """
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        if settings.getbool("CRAWLSTATE_RESUME", True) and not settings.get("JOBDIR"):
+            jobdir = Path(settings.get("CRAWLSTATE_DIR", ".crawlstate")) / cls.name / "job"
+            settings.set("JOBDIR", str(jobdir), priority="spider")
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        if crawler.settings.get("JOBDIR"):
+            spider.check_jobdir(Path(crawler.settings.get("JOBDIR")))
+        crawler.signals.connect(spider.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(spider.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(spider.item_error, signal=signals.item_error)
+        return spider
+
+    @property
+    def crawl_key(self) -> str:
+        """What is being crawled, the spider name unless its arguments decide that"""
+        return self.name
+
+    def check_jobdir(self, jobdir: Path):
+        path = jobdir / "crawl_key"
+        if path.exists() and path.read_text() != self.crawl_key:
+            raise ValueError(
+                f"{jobdir} holds the frontier of {path.read_text()}, not {self.crawl_key}: "
+                f"pass -s JOBDIR=... to checkpoint this crawl separately, or delete {jobdir}"
+            )
+        jobdir.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.crawl_key)
+
+    @property
+    def crawl_state(self) -> CrawlState:
+        if getattr(self, "_crawl_state", None) is None:
+            self._crawl_state = CrawlState.from_settings(self.settings, self.crawl_key)
+        return self._crawl_state
+
+    def completed(self, url: str, kind: ty.Optional[str] = None):
+        self.crawl_state.mark_scraped(url, kind=kind)
+        self.crawler.stats.inc_value(f"crawlstate/{kind or 'page'}_completed")
+
+    @property
+    def unpersisted(self) -> ty.Dict[str, ty.List[ty.Tuple[str, ty.Optional[str]]]]:
+        """item url -> (url, kind) of the pages completed once that item is written"""
+        if getattr(self, "_unpersisted", None) is None:
+            self._unpersisted = {}
+        return self._unpersisted
+
+    def scraped(self, item, url: str, kind: ty.Optional[str] = None):
+        """Yield `item` through this, `url` is completed once the pipelines have written the item"""
+        self.unpersisted.setdefault(str(item.get("url")), []).append((url, kind))
+        return item
+
+    def persisted(self, item_urls: ty.Iterable[str]):
+        """Called by the db pipelines once the items with these urls are committed"""
+        for item_url in item_urls:
+            for url, kind in self.unpersisted.pop(item_url, ()):
+                self.completed(url, kind=kind)
+
+    def failed(self, item_urls: ty.Iterable[str], error: str, final: bool = False):
+        """
+        Called by the db pipelines for the items they won't write. Their pages are retried
+        up to CRAWLSTATE_MAX_RETRIES times by later runs, or not at all when `final`
+        (e.g. invalid items, which would be just as invalid the next time).
+        """
+        for item_url in item_urls:
+            for url, kind in self.unpersisted.pop(item_url, ()):
+                self.crawl_state.mark_failed(url, error=error, kind=kind, final=final)
+                self.crawler.stats.inc_value(f"crawlstate/{kind or 'page'}_failed")
+
+    def item_dropped(self, item, response, exception, spider):
+        self.failed([str(item.get("url"))], f"dropped: {exception}", final=True)
+
+    def item_error(self, item, response, spider, failure):
+        self.failed([str(item.get("url"))], repr(failure.value))
+
+    def item_scraped(self, item, response, spider):
+        # without a pipeline reporting what it wrote, an item counts as written once
+        # it made it through the pipelines
+        if getattr(self, "_pipelines_persist", None) is None:
+            self._pipelines_persist = any(
+                getattr(p, "reports_persisted", False) for p in self.crawler.engine.scraper.itemproc.middlewares
+            )
+        if not self._pipelines_persist:
+            self.persisted([str(item.get("url"))])
+
+    def request_once(self, request, response=None):
+        """
+        process_request for CrawlSpider rules: `request` unless it was made already in this
+        run. The crawl state rather than the dupefilter decides what is requested again, as
+        the seen requests of the JOBDIR include those of pages whose items a crash lost.
+        """
+        if getattr(self, "_requested", None) is None:
+            self._requested = set()
+        if request.url in self._requested:
+            return None
+        self._requested.add(request.url)
+        return request.replace(dont_filter=True)
+
+    def skip_completed(self, request, response=None):
+        """process_request for CrawlSpider rules, drops requests for pages already scraped"""
+        if self.crawl_state.is_done(request.url):
+            self.crawler.stats.inc_value("crawlstate/skipped")
+            return None
+        return self.request_once(request, response)
+
+    def closed(self, reason):
+        if self.unpersisted:
+            self.logger.warning(f"{len(self.unpersisted)} scraped items were never written, their pages are scraped again next time")
+        self.logger.info(f"Crawl state: {self.crawl_state.counts()}")
+        self.crawl_state.close()
+        if reason == "finished" and self.settings.get("JOBDIR"):
+            # nothing left to resume, a crawl of anything else may use the JOBDIR now
+            (Path(self.settings.get("JOBDIR")) / "crawl_key").unlink(missing_ok=True)
+
+
+class CrawlStateMiddleware:
+    """
+    Downloader middleware: drops the requests for pages (those with a `kind` in their meta)
+    of a resumable spider which were completed after the request was queued, e.g. pending
+    requests restored from the JOBDIR which the resumed crawl has queued again as well.
+    """
+
+    def process_request(self, request, spider):
+        if request.meta.get("kind") is None or not isinstance(spider, ResumableSpider):
+            return None
+        if spider.crawl_state.is_done(request.url):
+            spider.crawler.stats.inc_value("crawlstate/skipped")
+            raise IgnoreRequest(f"Already scraped: {request.url}")
+        return None
+
+
+def read_scraped_csv(path: Path) -> ty.List[str]:
+    with open(path, newline="") as fp:
+        return [row["url"] for row in csv.DictReader(fp) if row.get("url")]
+
+
+def read_failed_log(path: Path) -> ty.List[str]:
+    return [line.strip() for line in Path(path).read_text().splitlines() if line.strip()]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", type=Path, help="crawl state file")
+    parser.add_argument("--scraped", type=Path, action="append", default=[], help="csv of scraped urls")
+    parser.add_argument("--failed", type=Path, action="append", default=[], help="log of failed urls, one per line")
+    args = parser.parse_args()
+
+    state = CrawlState(args.db)
+    for path in args.scraped:
+        logger.info(f"Imported {state.import_urls(read_scraped_csv(path), SCRAPED)} scraped urls from {path}")
+    for path in args.failed:
+        logger.info(f"Imported {state.import_urls(read_failed_log(path), FAILED)} failed urls from {path}")
+    logger.info(f"Crawl state {args.db}: {state.counts()}")
+    state.close()
@@ -1,64 +1,420 @@
 import logging
+import time
 import typing as ty
 import sys
 sys.path.insert(0, ".")
 
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlmodel import SQLModel, create_engine, Session, select
+from sqlalchemy import func, literal_column, text
+from sqlalchemy.dialects.postgresql import Insert, insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlmodel import SQLModel, create_engine, Session
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from scraper.settings import get_settings
-from scraper.models import Keyword, Author, ConferenceItem, KeywordPubLink, AuthorPubLink
+from scraper.models import Keyword, Author, ConferenceItem, KeywordPubLink, AuthorPubLink, RenderedPage, keyword_natural_key
+from scraper.identity import IdentityMap
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
-settings = get_settings()
-engine = create_engine(settings.database_url, echo=settings.echo_sql)
-async_engine = create_async_engine(settings.async_database_url, echo=settings.echo_sql)
+class PoolMetrics:
+    """Time spent waiting for a connection from a pool, and peak pool usage"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.checked_out_max = 0
+
+    def record(self, wait: float, checked_out: int):
+        self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.checked_out_max = max(self.checked_out_max, checked_out)
+
+    def as_dict(self) -> ty.Dict[str, ty.Union[int, float]]:
+        return {
+            "checkouts": self.checkouts,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.,
+            "checked_out_max": self.checked_out_max,
+        }
+
+
+pool_metrics = {"sync": PoolMetrics(), "async": PoolMetrics()}
+
+
+def _timed_pool(pool_cls: ty.Type[QueuePool], metrics: PoolMetrics) -> ty.Type[QueuePool]:
+    class TimedPool(pool_cls):
+        def _do_get(self):
+            start = time.perf_counter()
+            connection = super()._do_get()
+            metrics.record(time.perf_counter() - start, self.checkedout())
+            return connection
+    return TimedPool
+
+
+_engines = {}
+
+
+def get_engine() -> Engine:
+    """The sync engine, created on first use"""
+    if "sync" not in _engines:
+        settings = get_settings()
+        _engines["sync"] = create_engine(
+            settings.database_url,
+            echo=settings.echo_sql,
+            poolclass=_timed_pool(QueuePool, pool_metrics["sync"]),
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_pre_ping=settings.db_pool_pre_ping,
+            pool_recycle=settings.db_pool_recycle,
+        )
+    return _engines["sync"]
+
+
+def get_async_engine() -> AsyncEngine:
+    """The asyncpg engine, created on first use"""
+    if "async" not in _engines:
+        settings = get_settings()
+        _engines["async"] = create_async_engine(
+            settings.async_database_url,
+            echo=settings.echo_sql,
+            poolclass=_timed_pool(AsyncAdaptedQueuePool, pool_metrics["async"]),
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_pre_ping=settings.db_pool_pre_ping,
+            pool_recycle=settings.db_pool_recycle,
+            connect_args={
+                "statement_cache_size": settings.db_statement_cache_size,
+                "prepared_statement_cache_size": settings.db_prepared_statement_cache_size,
+            },
+        )
+    return _engines["async"]
+
+
+def dispose_engine():
+    """Close all pooled connections of the sync engine, if it was ever created"""
+    if (engine := _engines.pop("sync", None)) is not None:
+        engine.dispose()
+
+
+async def async_dispose_engine():
+    """Close all pooled connections of the async engine, if it was ever created"""
+    if (engine := _engines.pop("async", None)) is not None:
+        await engine.dispose()
+
+
+def pool_stats() -> ty.Dict[str, ty.Union[int, float]]:
+    """Flat `<engine>/<metric>` dict of the pool checkout metrics"""
+    return {
+        f"{kind}/{k}": v
+        for kind, metrics in pool_metrics.items()
+        for k, v in metrics.as_dict().items()
+    }
+
+
+def __getattr__(name: str):
+    # `engine` and `async_engine` used to be module globals built at import time
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    SQLModel.metadata.create_all(get_engine())
 
 
 def drop_all_tables():
-    SQLModel.metadata.drop_all(engine)
-
-
-def get_or_create(model: SQLModel, session: Session, **kwargs) -> SQLModel:
-    # look for full match on all attributes by default
-    # figure out if this works as intended with relationship keys
-    # it may also make sense to make the kwargs actually just a set of attributes:
-    # the values are already fixed by the model
-    if not kwargs:
-        kwargs = {k:v for k, v in model.dict().items() if v is not None}
-    logger.debug(f"filtering by {kwargs}")
-    instance = session.query(model.__class__).filter_by(**kwargs).first()
-    if instance:
-        logger.warning(f"model already exists in db: {instance}")
-        return instance
-    logger.debug(f"model doesnt exist yet: {model}")
-    return model
-
-
-async def async_get_or_create(model: SQLModel, session: AsyncSession, **kwargs) -> SQLModel:
-    # look for full match on all attributes by default
-    # figure out if this works as intended with relationship keys
-    # it may also make sense to make the kwargs actually just a set of attributes:
-    # the values are already fixed by the model
-    if not kwargs:
-        kwargs = {k:v for k, v in model.dict().items() if v is not None}
-    logger.debug(f"filtering by {kwargs}")
-    q = select(model.__class__).filter_by(**kwargs)
-    result = await session.execute(q)
-    instance = result.scalar_one_or_none()
-    #instance = await session.query(model.__class__).filter_by(**kwargs).first()
-    if instance:
-        logger.warning(f"model already exists in db: {instance}")
-        return instance
-    logger.debug(f"model doesnt exist yet: {model}")
-    return model
+    SQLModel.metadata.drop_all(get_engine())
+
+
+def keyword_key(type_: ty.Optional[str], value: str) -> ty.Tuple[ty.Optional[str], str]:
+    # mirrors the coalesce(type, '') in the keyword unique index
+    return (type_ or None, value)
+
+
+class ItemRow(ty.NamedTuple):
+    """
+    A validated item as plain values: its conferenceitem columns, then the author names
+    and (type, value) keyword keys it is linked to. What the upsert statements are built from.
+    """
+    url: str
+    title: str
+    item_type: ty.Optional[str] = None
+    conference: ty.Optional[str] = None
+    year: ty.Optional[int] = None
+    abstract: ty.Optional[str] = None
+    paper_url: ty.Optional[str] = None
+    openreview_url: ty.Optional[str] = None
+    poster_url: ty.Optional[str] = None
+    slides_url: ty.Optional[str] = None
+    authors: ty.Tuple[str, ...] = ()
+    keywords: ty.Tuple[ty.Tuple[ty.Optional[str], str], ...] = ()
+
+    def columns(self) -> ty.Dict[str, ty.Any]:
+        return dict(zip(ITEM_COLUMNS, self))
+
+
+ITEM_COLUMNS: ty.Tuple[str, ...] = ItemRow._fields[:-2]
+
+
+def item_row(item: ConferenceItem) -> ItemRow:
+    """The row of an already built ConferenceItem"""
+    values = [getattr(item, c) for c in ITEM_COLUMNS]
+    values[0] = str(values[0])
+    return ItemRow(
+        *values,
+        authors=tuple(dict.fromkeys(a.name for a in item.authors)),
+        keywords=tuple(dict.fromkeys(keyword_key(k.type, k.value) for k in (item.keywords or []))),
+    )
+
+
+# -- upsert statements
+# Each is a single INSERT ... ON CONFLICT ... RETURNING, safe under concurrent writers.
+# `DO UPDATE` on the natural key (rather than DO NOTHING) makes rows which already
+# exist show up in RETURNING too; `inserted` tells new rows apart from existing ones.
+inserted = literal_column("xmax = 0").label("inserted")
+
+
+def author_upsert(names: ty.Iterable[str]) -> Insert:
+    q = pg_insert(Author).values([{"name": n} for n in names])
+    return q.on_conflict_do_update(
+        index_elements=[Author.name], set_={"name": q.excluded.name}
+    ).returning(Author.id, Author.name, inserted)
+
+
+def keyword_upsert(pairs: ty.Iterable[ty.Tuple[ty.Optional[str], str]]) -> Insert:
+    q = pg_insert(Keyword).values([{"type": t, "value": v} for t, v in pairs])
+    return q.on_conflict_do_update(
+        index_elements=list(keyword_natural_key), set_={"value": q.excluded.value}
+    ).returning(Keyword.id, Keyword.type, Keyword.value, inserted)
+
+
+def item_upsert(rows: ty.Sequence[ty.Dict[str, ty.Any]], update: bool = True) -> Insert:
+    """
+    Items conflict on url. With `update` a re-scraped item overwrites the stored fields
+    it has a value for (a field it lacks never blanks a stored one), otherwise the stored
+    row is kept as is (but still returned).
+    """
+    q = pg_insert(ConferenceItem).values(rows)
+    if update:
+        table = ConferenceItem.__table__.c
+        set_ = {c: func.coalesce(getattr(q.excluded, c), table[c]) for c in rows[0] if c != "url"}
+    else:
+        # no-op update so that the existing row is still returned
+        set_ = {"url": q.excluded.url}
+    return q.on_conflict_do_update(
+        index_elements=[ConferenceItem.url], set_=set_
+    ).returning(ConferenceItem.id, ConferenceItem.url, inserted)
+
+
+def link_insert(model: ty.Type[SQLModel], rows: ty.Sequence[ty.Dict[str, int]]) -> Insert:
+    return pg_insert(model).values(rows).on_conflict_do_nothing()
+
+
+def page_upsert(rows: ty.Sequence[ty.Dict[str, ty.Any]]) -> Insert:
+    """Store rendered pages, replacing earlier renders of the same url"""
+    stmt = pg_insert(RenderedPage).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[RenderedPage.url],
+        set_={c: stmt.excluded[c] for c in ("spider", "body", "fetched_at")},
+    )
+
+
+class UpsertPlan:
+    """
+    The statements persisting a batch of items, in dependency order. Kept free of any
+    session so the same plan is executed by the sync and async pipelines.
+    """
+
+    def __init__(self, items: ty.Sequence[ty.Union[ItemRow, ConferenceItem]], cache: ty.Optional[IdentityMap] = None):
+        self.cache = cache
+        self.n_rows = 0
+        self.author_ids = {}
+        self.keyword_ids = {}
+        self.item_ids = {}
+        # first occurrence of a url wins, ON CONFLICT can't touch a row twice
+        self.items: ty.Dict[str, ItemRow] = {}
+        for item in items:
+            row = item if isinstance(item, ItemRow) else item_row(item)
+            self.items.setdefault(row.url, row)
+        self.names = {name for row in self.items.values() for name in row.authors}
+        self.pairs = {pair for row in self.items.values() for pair in row.keywords}
+        if cache is not None:
+            for name in self.names:
+                if (id_ := cache.get(Author(name=name))) is not None:
+                    self.author_ids[name] = id_
+            for type_, value in self.pairs:
+                if (id_ := cache.get(Keyword(type=type_, value=value))) is not None:
+                    self.keyword_ids[(type_, value)] = id_
+            self.names -= self.author_ids.keys()
+            self.pairs -= self.keyword_ids.keys()
+
+    def _count(self, result) -> ty.List[tuple]:
+        rows = result.all()
+        self.n_rows += sum(1 for *_, is_new in rows if is_new)
+        return rows
+
+    def entity_statements(self) -> ty.Iterator[ty.Tuple[Insert, ty.Callable]]:
+        """Yields (statement, on_result) pairs resolving authors and keywords to ids"""
+        if self.names:
+            yield author_upsert(sorted(self.names)), self._on_authors
+        if self.pairs:
+            yield keyword_upsert(sorted(self.pairs, key=lambda p: (p[0] or "", p[1]))), self._on_keywords
+
+    def _on_authors(self, result):
+        for id_, name, _ in self._count(result):
+            self.author_ids[name] = id_
+
+    def _on_keywords(self, result):
+        for id_, type_, value, _ in self._count(result):
+            self.keyword_ids[keyword_key(type_, value)] = id_
+
+    def remember(self):
+        """
+        Put the ids resolved by this plan into the cache. Only call this once the
+        transaction has committed, other writers must never see uncommitted ids.
+        """
+        if self.cache is None:
+            return
+        for name in self.names:
+            self.cache.put(Author(name=name), self.author_ids[name])
+        for type_, value in self.pairs:
+            self.cache.put(Keyword(type=type_, value=value), self.keyword_ids[(type_, value)])
+
+    def item_statement(self) -> Insert:
+        # sorted like the other statements so concurrent writers lock rows in the same order
+        return item_upsert([self.items[url].columns() for url in sorted(self.items)])
+
+    def on_items(self, result):
+        for id_, url, _ in self._count(result):
+            self.item_ids[url] = id_
+
+    def link_statements(self) -> ty.Iterator[Insert]:
+        author_links = {
+            (self.author_ids[name], self.item_ids[url])
+            for url, row in self.items.items() for name in row.authors
+        }
+        keyword_links = {
+            (self.keyword_ids[pair], self.item_ids[url])
+            for url, row in self.items.items() for pair in row.keywords
+        }
+        if author_links:
+            yield link_insert(AuthorPubLink, [
+                {"author_id": a, "confitem_id": i} for a, i in sorted(author_links)
+            ])
+        if keyword_links:
+            yield link_insert(KeywordPubLink, [
+                {"keyword_id": k, "confitem_id": i} for k, i in sorted(keyword_links)
+            ])
+
+
+def bulk_insert_items(items: ty.Sequence[ty.Union[ItemRow, ConferenceItem]], session: Session, cache: ty.Optional[IdentityMap] = None) -> UpsertPlan:
+    """
+    Upsert a batch of validated items (rows, or ConferenceItem models) with one statement per table.
+
+    Authors and keywords found in `cache` are not sent to the db at all, existing items
+    (same url) are updated in place. The caller owns the transaction and should call
+    `remember()` on the returned plan after committing; `n_rows` on the plan counts the
+    rows inserted across all tables.
+    """
+    plan = UpsertPlan(items, cache=cache)
+    if not plan.items:
+        return plan
+    for q, on_result in plan.entity_statements():
+        on_result(session.execute(q))
+    plan.on_items(session.execute(plan.item_statement()))
+    for q in plan.link_statements():
+        plan.n_rows += session.execute(q).rowcount
+    return plan
+
+
+async def async_bulk_insert_items(items: ty.Sequence[ty.Union[ItemRow, ConferenceItem]], session: AsyncSession, cache: ty.Optional[IdentityMap] = None) -> UpsertPlan:
+    """Async twin of bulk_insert_items"""
+    plan = UpsertPlan(items, cache=cache)
+    if not plan.items:
+        return plan
+    for q, on_result in plan.entity_statements():
+        on_result(await session.execute(q))
+    plan.on_items(await session.execute(plan.item_statement()))
+    for q in plan.link_statements():
+        plan.n_rows += (await session.execute(q)).rowcount
+    return plan
+
+
+def migrate_natural_keys():
+    """
+    Bring a database created before the natural key constraints existed up to date:
+    merge duplicate authors/keywords/items onto their lowest id, then create the
+    unique indexes. Idempotent.
+    """
+    statements = [
+        # authors
+        """
+        WITH dup AS (
+            SELECT id, min(id) OVER (PARTITION BY name) AS keep FROM author
+        ), moved AS (
+            INSERT INTO authorpublink (author_id, confitem_id)
+            SELECT DISTINCT dup.keep, l.confitem_id FROM authorpublink l JOIN dup ON dup.id = l.author_id
+            WHERE dup.id <> dup.keep
+            ON CONFLICT DO NOTHING
+        )
+        DELETE FROM authorpublink l USING dup WHERE l.author_id = dup.id AND dup.id <> dup.keep
+        """,
+        "DELETE FROM author a USING author b WHERE a.name = b.name AND a.id > b.id",
+        """
+        DO $$ BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = 'ix_author_name' AND i.indisunique
+            ) THEN
+                DROP INDEX IF EXISTS ix_author_name;
+                CREATE UNIQUE INDEX ix_author_name ON author (name);
+            END IF;
+        END $$
+        """,
+        # keywords
+        """
+        WITH dup AS (
+            SELECT id, min(id) OVER (PARTITION BY coalesce(type, ''), value) AS keep FROM keyword
+        ), moved AS (
+            INSERT INTO keywordpublink (keyword_id, confitem_id)
+            SELECT DISTINCT dup.keep, l.confitem_id FROM keywordpublink l JOIN dup ON dup.id = l.keyword_id
+            WHERE dup.id <> dup.keep
+            ON CONFLICT DO NOTHING
+        )
+        DELETE FROM keywordpublink l USING dup WHERE l.keyword_id = dup.id AND dup.id <> dup.keep
+        """,
+        """
+        DELETE FROM keyword a USING keyword b
+        WHERE coalesce(a.type, '') = coalesce(b.type, '') AND a.value = b.value AND a.id > b.id
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_keyword_type_value ON keyword (coalesce(type, ''), value)",
+        # items, links of the duplicates go with them
+        """
+        WITH dup AS (
+            SELECT a.id FROM conferenceitem a JOIN conferenceitem b ON a.url = b.url AND a.id > b.id
+        ), al AS (
+            DELETE FROM authorpublink l USING dup WHERE l.confitem_id = dup.id
+        ), kl AS (
+            DELETE FROM keywordpublink l USING dup WHERE l.confitem_id = dup.id
+        )
+        DELETE FROM conferenceitem c USING dup WHERE c.id = dup.id
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS conferenceitem_url_key ON conferenceitem (url)",
+    ]
+    with get_engine().begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
 
 
 # quick test SQLmodel working as intended
@@ -80,34 +436,27 @@ if __name__ == "__main__":
     logger.info("validate")
     p = ConferenceItem.validate(d)
 
-    # duplicates to check get_or_create logic
+    # duplicate authors/keywords within and across items are written once
     k2 = Keyword(value="Interesting")
     k3 = Keyword(value="Interesting")
 
     a2 = Author(name="Mr. Bean")
     a3 = Author(name="Mr. Bean")
 
-    with Session(engine) as sesh:
-        m = get_or_create(p, sesh)
-        sesh.add(m)
-        sesh.commit()
+    p.keywords += [k2, k3]
+    p.authors += [a2, a3]
+    with Session(get_engine()) as sesh, sesh.begin():
+        logger.info(f"bulk insert wrote {bulk_insert_items([p], sesh).n_rows} rows")
 
-        kk = get_or_create(k2, sesh)
-        sesh.add(kk)
-        sesh.commit()
-
-        kk = get_or_create(k3, sesh)
-        sesh.add(kk)
-        sesh.commit()
-
-        
-        aa = get_or_create(a2, sesh)
-        sesh.add(aa)
-        sesh.commit()
-
-        aa = get_or_create(a3, sesh)
-        sesh.add(aa)
-        sesh.commit()
+    # upsert path: existing authors/keywords are reused, the duplicate item is merged
+    b = ConferenceItem(
+        title="Bulk Paper",
+        url="https://www.bulk.paper",
+        authors=[Author(name="Mr. Bean"), Author(name="New Person")],
+        keywords=[Keyword(value="Interesting")]
+    )
+    with Session(get_engine()) as sesh, sesh.begin():
+        logger.info(f"bulk insert wrote {bulk_insert_items([b, b], sesh).n_rows} rows")
 
     # test creating 2 different publications with the same keywords and see if the keyword entries are duplicated?
 
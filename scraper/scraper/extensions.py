@@ -0,0 +1,68 @@
+"""
+extensions.py
+"""
+import logging
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReactorStallMonitor:
+    """
+    Measures how long the reactor thread is blocked: a timer scheduled every
+    REACTOR_STALL_INTERVAL seconds that fires more than REACTOR_STALL_THRESHOLD seconds
+    late means something (e.g. a blocking db call) held the reactor for that long, during
+    which no downloads were scheduled and no callbacks ran. Reported as reactor/stall_*
+    stats, e.g. to compare SQLMODEL_WRITER_THREADS=0 against the threaded writes.
+    """
+
+    def __init__(self, stats, interval: float = 0.1, threshold: float = 0.05):
+        self.stats = stats
+        self.interval = interval
+        self.threshold = threshold
+        self.call = None
+        self.due = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("REACTOR_STALL_MONITOR", True):
+            raise NotConfigured
+        ext = cls(
+            crawler.stats,
+            interval=crawler.settings.getfloat("REACTOR_STALL_INTERVAL", 0.1),
+            threshold=crawler.settings.getfloat("REACTOR_STALL_THRESHOLD", 0.05),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self.schedule()
+
+    def schedule(self):
+        # not imported at module level, which would install the default reactor before
+        # the crawler installs TWISTED_REACTOR
+        from twisted.internet import reactor
+        self.due = time.perf_counter() + self.interval
+        self.call = reactor.callLater(self.interval, self.tick)
+
+    def tick(self):
+        lag = time.perf_counter() - self.due
+        self.schedule()
+        if lag > self.threshold:
+            self.stats.inc_value("reactor/stalls")
+            self.stats.inc_value("reactor/stall_time", lag, start=0.)
+            self.stats.max_value("reactor/stall_max", lag)
+
+    def spider_closed(self, spider):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        stall_time = self.stats.get_value("reactor/stall_time", 0.)
+        logger.info(
+            f"Reactor stalled {self.stats.get_value('reactor/stalls', 0)} times for {stall_time:.2f}s in total, "
+            f"longest {self.stats.get_value('reactor/stall_max', 0.):.2f}s"
+        )
@@ -0,0 +1,89 @@
+"""
+harvest.py
+
+Incremental link harvesting from infinite-scroll listings. A MutationObserver installed
+in the page records every new link matching a selector as it is rendered, so each
+scroll step only has to drain what's new instead of re-querying the whole list, and the
+links can be streamed to the caller (e.g. turned into requests) while scrolling goes on.
+"""
+import logging
+import time
+import typing as ty
+
+from playwright.async_api import Page, TimeoutError as PlaywrightTimeoutError
+
+from scraper.waits import site_key, timeouts
+
+
+logger = logging.getLogger(__name__)
+
+# records [absolute href, text] of every element matching `selector`, present or added later
+OBSERVE_LINKS_JS = """
+(selector) => {
+  if (window.__harvest) {
+    window.__harvest.observer.disconnect();
+  }
+  const state = {seen: new Set(), queue: []};
+  const add = (el) => {
+    const href = el.getAttribute("href");
+    if (href && !state.seen.has(href)) {
+      state.seen.add(href);
+      state.queue.push([el.href, (el.innerText || "").trim().slice(0, 200)]);
+    }
+  };
+  const scan = (node) => {
+    if (node.nodeType !== Node.ELEMENT_NODE) return;
+    if (node.matches(selector)) add(node);
+    node.querySelectorAll(selector).forEach(add);
+  };
+  scan(document.body);
+  state.observer = new MutationObserver((mutations) => {
+    for (const m of mutations) m.addedNodes.forEach(scan);
+  });
+  state.observer.observe(document.body, {childList: true, subtree: true});
+  window.__harvest = state;
+}
+"""
+DRAIN_JS = "() => window.__harvest.queue.splice(0)"
+HAS_NEW_JS = "() => window.__harvest.queue.length > 0"
+STOP_JS = "() => window.__harvest && window.__harvest.observer.disconnect()"
+
+
+async def harvest_links(page: Page, selector: str, min_items: int = 0, max_idle: int = 2,
+                        focus_selector: ty.Optional[str] = None) -> ty.AsyncIterator[ty.Tuple[str, str]]:
+    """
+    Scroll `page` to the end of its listing, yielding (url, text) of each link matching
+    the css `selector` as soon as it is rendered. Stops once `max_idle` scrolls in a row
+    brought nothing new and at least `min_items` links were seen, or gives up after ten
+    times as many idle scrolls.
+    """
+    key = site_key(page.url, "scroll")
+    await page.evaluate(OBSERVE_LINKS_JS, selector)
+    if focus_selector is not None:
+        # the End key scrolls whatever has focus
+        await page.click(focus_selector)
+    n_links = 0
+    idle = 0
+    try:
+        while True:
+            for url, text in await page.evaluate(DRAIN_JS):
+                n_links += 1
+                yield url, text
+            if idle >= max_idle and n_links >= min_items:
+                break
+            if idle >= 10 * max_idle:
+                logger.warning(f"Stopped scrolling {page.url} with {n_links} < {min_items} links")
+                break
+            await page.keyboard.press("End")
+            start = time.perf_counter()
+            try:
+                await page.wait_for_function(HAS_NEW_JS, timeout=timeouts.timeout(key) * 1000)
+            except PlaywrightTimeoutError:
+                timeouts.missed(key)
+                idle += 1
+            else:
+                timeouts.observe(key, time.perf_counter() - start)
+                idle = 0
+    finally:
+        await page.evaluate(STOP_JS)
+    logger.info(f"Harvested {n_links} links from {page.url}")
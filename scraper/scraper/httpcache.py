@@ -0,0 +1,168 @@
+"""
+httpcache.py
+
+Render-aware HTTP cache backend: every response (plain, Splash-rendered or Playwright-
+rendered) is stored zlib-compressed in a single SQLite file per spider, keyed by the
+request fingerprint plus the render parameters (Splash args incl. the Lua script,
+Playwright page methods), with TTL and size-based LRU eviction.
+
+With RENDERCACHE_OFFLINE the cache is replayed without touching the network: entries
+never expire and requests missing from the cache are dropped, so parsers can be re-run
+against the stored HTML at CPU speed, e.g.
+
+    scrapy crawl icml_2022_crawler -s RENDERCACHE_OFFLINE=1
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import typing as ty
+import zlib
+from pathlib import Path
+
+from scrapy import Request, Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def render_params(request: Request) -> ty.Dict[str, ty.Any]:
+    """The parts of a request, besides the request itself, which determine the rendered page"""
+    params = {}
+    splash = request.meta.get("splash")
+    if splash:
+        params["splash"] = {
+            "endpoint": splash.get("endpoint"),
+            "args": {k: v for k, v in splash.get("args", {}).items() if k not in ("url", "lua_source")},
+            "lua": hashlib.sha1(splash.get("args", {}).get("lua_source", "").encode()).hexdigest(),
+        }
+    if request.meta.get("playwright"):
+        params["playwright"] = [
+            (m.method, [str(a) for a in m.args], {k: str(v) for k, v in m.kwargs.items()})
+            for m in request.meta.get("playwright_page_methods", [])
+        ]
+    return params
+
+
+class RenderCachePolicy(DummyPolicy):
+    """
+    Caches everything but Playwright requests which hand their live page to the
+    callback (playwright_include_page), those can't be replayed from a stored body.
+    """
+
+    def should_cache_request(self, request):
+        if request.meta.get("playwright_include_page"):
+            return False
+        return super().should_cache_request(request)
+
+
+class SQLiteRenderCacheStorage:
+    """
+    HTTPCACHE_STORAGE backend. One `<HTTPCACHE_DIR>/<spider>.sqlite` file per spider,
+    bodies zlib-compressed, expired after HTTPCACHE_EXPIRATION_SECS (0: never) and least
+    recently used entries evicted once the bodies exceed RENDERCACHE_MAX_BYTES (0: no cap).
+    """
+
+    def __init__(self, settings):
+        self.cachedir = Path(data_path(settings["HTTPCACHE_DIR"], createdir=True))
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.max_bytes = settings.getint("RENDERCACHE_MAX_BYTES", 0)
+        self.compression_level = settings.getint("RENDERCACHE_COMPRESSION_LEVEL", 6)
+        self.offline = settings.getbool("RENDERCACHE_OFFLINE")
+        self.db = None
+
+    def open_spider(self, spider: Spider):
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        self.stats = spider.crawler.stats
+        path = self.cachedir / f"{spider.name}.sqlite"
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers BLOB NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+        if self.expiration_secs > 0 and not self.offline:
+            self.db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.expiration_secs,))
+        self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM responses").fetchone()[0]
+        n_entries = self.db.execute("SELECT count(*) FROM responses").fetchone()[0]
+        logger.info(f"Render cache {path}: {n_entries} entries, {self.size / 2**20:.1f}MiB{' (offline replay)' if self.offline else ''}")
+
+    def close_spider(self, spider: Spider):
+        if self.db is not None:
+            self.stats.set_value("rendercache/size_bytes", self.size)
+            self.db.close()
+            self.db = None
+
+    def key(self, request: Request) -> str:
+        h = hashlib.sha1(self._fingerprinter.fingerprint(request))
+        params = render_params(request)
+        if params:
+            h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def retrieve_response(self, spider: Spider, request: Request):
+        key = self.key(request)
+        row = self.db.execute(
+            "SELECT url, status, headers, body, stored_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            if self.offline:
+                raise IgnoreRequest(f"Not in render cache (offline replay): {request.url}")
+            return None
+        url, status, raw_headers, body, stored_at = row
+        if not self.offline and 0 < self.expiration_secs < time.time() - stored_at:
+            return None
+        self.db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        body = zlib.decompress(body)
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider: Spider, request: Request, response):
+        if self.offline:
+            return
+        body = zlib.compress(response.body, self.compression_level)
+        now = time.time()
+        key = self.key(request)
+        old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, response.url, response.status, headers_dict_to_raw(response.headers), body, len(body), now, now),
+        )
+        self.size += len(body) - (old[0] if old else 0)
+        self.stats.inc_value("rendercache/stored_bytes", len(body))
+        self.stats.inc_value("rendercache/raw_bytes", len(response.body))
+        if self.max_bytes and self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target_bytes: int):
+        """Drop least recently used entries until the bodies fit in `target_bytes`"""
+        evicted = 0
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        keys = []
+        for key, size in rows:
+            if self.size <= target_bytes:
+                break
+            keys.append((key,))
+            self.size -= size
+            evicted += 1
+        self.db.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.stats.inc_value("rendercache/evicted", evicted)
+        logger.info(f"Evicted {evicted} entries from the render cache")
@@ -0,0 +1,87 @@
+"""
+identity.py
+
+In-process identity map for the entities that repeat across a crawl (authors, keywords),
+so that resolving them to primary keys does not need a db round-trip every time.
+"""
+import logging
+import threading
+import typing as ty
+from collections import OrderedDict
+
+from sqlmodel import SQLModel, Session, select
+
+from scraper.models import Author, Keyword
+
+
+logger = logging.getLogger(__name__)
+
+
+def natural_key(model: SQLModel) -> ty.Hashable:
+    if isinstance(model, Author):
+        return model.name
+    if isinstance(model, Keyword):
+        # '' and NULL types collide in the keyword unique index
+        return (model.type or None, model.value)
+    raise TypeError(f"no natural key defined for {type(model).__name__}")
+
+
+class IdentityMap:
+    """
+    Bounded LRU map of natural key -> primary key, one per cached model class.
+    Authors are keyed by name, keywords by (type, value). Safe to share between the
+    pipelines' writer threads.
+    """
+    models: ty.Tuple[ty.Type[SQLModel], ...] = (Author, Keyword)
+
+    def __init__(self, maxsize: int = 50_000):
+        self.maxsize = maxsize
+        self.ids = {m: OrderedDict() for m in self.models}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self.ids.values())
+
+    def __contains__(self, model: SQLModel) -> bool:
+        return type(model) in self.ids
+
+    def get(self, model: SQLModel) -> ty.Optional[int]:
+        ids = self.ids[type(model)]
+        key = natural_key(model)
+        with self.lock:
+            id_ = ids.get(key)
+            if id_ is None:
+                self.misses += 1
+                return None
+            ids.move_to_end(key)
+            self.hits += 1
+        return id_
+
+    def put(self, model: SQLModel, id_: ty.Optional[int] = None):
+        ids = self.ids[type(model)]
+        key = natural_key(model)
+        with self.lock:
+            ids[key] = model.id if id_ is None else id_
+            ids.move_to_end(key)
+            while len(ids) > self.maxsize:
+                ids.popitem(last=False)
+
+    def warm(self, session: Session):
+        """Pre-load the most recently inserted rows of each cached model"""
+        for model in self.models:
+            q = select(model).order_by(model.id.desc()).limit(self.maxsize)
+            # oldest first so the most recent rows end up at the MRU end
+            for instance in reversed(session.exec(q).all()):
+                self.put(instance)
+        logger.info(f"Identity map warmed with {len(self)} entries")
+
+    def stats(self) -> ty.Dict[str, ty.Union[int, float]]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "size": len(self),
+        }
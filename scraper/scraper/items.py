@@ -8,9 +8,9 @@ import typing as ty
 import scrapy
 
 from itemloaders.processors import Join, MapCompose, TakeFirst
-from pydantic import AnyUrl, Field, validator
+from pydantic import AnyUrl, Field, ValidationError, validator
 
-from scraper.db import ConferenceItem, Author, Keyword
+from scraper.db import ConferenceItem, Author, Keyword, ItemRow, ITEM_COLUMNS, keyword_key
 
 
 def strip_space(string: str) -> str:
@@ -21,7 +21,21 @@ def split_name(authors: str) -> ty.List[str]:
     return authors.split(",")
 
 
-class ICMLLoaderItem(scrapy.Item):
+def split_keyword(v: str) -> ty.Tuple[ty.Optional[str], str]:
+    """`type: value` or just `value`"""
+    parts = v.split(":")
+    if len(parts) == 2:
+        return parts[0].rstrip(), parts[1].lstrip()
+    return None, parts[0]
+
+
+# ConferenceItem's own pydantic fields, so that rows are validated exactly like the model
+# (which, being a table model, never raises) without building it and its authors/keywords
+_column_fields = [(name, ConferenceItem.__fields__[name]) for name in ITEM_COLUMNS]
+
+
+class ConferenceLoaderItem(scrapy.Item):
+    """The fields every conference item has, subclasses add the site specific ones"""
     conference: str = scrapy.Field(output_processor=TakeFirst())
     year: int = scrapy.Field(output_processor=TakeFirst())
     url: ty.Optional[AnyUrl] = scrapy.Field(output_processor=TakeFirst())
@@ -31,110 +45,114 @@ class ICMLLoaderItem(scrapy.Item):
     keywords: ty.Optional[ty.List[str]] = scrapy.Field(input_processor=MapCompose(strip_space))
     abstract: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
     paper_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    poster_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst()) 
+    poster_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
     slides_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
 
     @classmethod
     def parse_keyword(cls, v) -> Keyword:
-        parts = v.split(":")
-        if len(parts) == 2:
-            return Keyword(type=parts[0].rstrip(), value=parts[1].lstrip())
-        return Keyword(type=None, value=parts[0])
+        type_, value = split_keyword(v)
+        return Keyword(type=type_, value=value)
 
     def to_sqlmodel(self) -> ConferenceItem:
         keywords = [self.parse_keyword(k) for k in set(self.get("keywords", []))]
         authors = [Author(name=n) for n in set(self.get("authors", []))]
         return ConferenceItem(
-            conference=self.get("conference"),
-            year=self.get("year"),
-            url=self.get("url"),
-            item_type=self.get("item_type"),
-            title=self.get("title"),
+            **{c: self.get(c) for c in ITEM_COLUMNS},
             authors=authors,
             keywords=keywords,
-            abstract=self.get("abstract"),
-            paper_url=self.get("paper_url"),
-            poster_url=self.get("poster_url"),
-            slides_url=self.get("slides_url")
         )
 
+    def to_row(self) -> ItemRow:
+        """Validate the item in a single pass into the plain values bulk_insert_items writes"""
+        values, errors = [], []
+        for name, field in _column_fields:
+            value, error = field.validate(self.get(name), {}, loc=name, cls=ConferenceItem)
+            if error:
+                errors.append(error)
+            values.append(value)
+        if errors:
+            raise ValidationError(errors, ConferenceItem)
+        values[0] = str(values[0])
+        return ItemRow(
+            *values,
+            authors=tuple(dict.fromkeys(self.get("authors") or ())),
+            keywords=tuple(dict.fromkeys(keyword_key(*split_keyword(k)) for k in self.get("keywords") or ())),
+        )
 
 
-class NeurIPSLoaderItem(scrapy.Item):
-    conference: str = scrapy.Field(output_processor=TakeFirst())
-    year: int = scrapy.Field(output_processor=TakeFirst())
-    url: ty.Optional[AnyUrl] = scrapy.Field(output_processor=TakeFirst())
-    item_type: ty.Optional[str] = scrapy.Field(input_processor=MapCompose(strip_space), output_processor=TakeFirst())
-    title: ty.Optional[str] = scrapy.Field(input_processor=MapCompose(strip_space), output_processor=TakeFirst())
-    authors: ty.Optional[ty.List[str]] = scrapy.Field(input_processor=MapCompose(strip_space, split_name))
-    keywords: ty.Optional[ty.List[str]] = scrapy.Field(input_processor=MapCompose(strip_space))
-    abstract: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    paper_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    openreview_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    poster_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst()) 
-    slides_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
+def validate_items(items: ty.Iterable[ConferenceLoaderItem]) -> ty.Tuple[ty.List[ItemRow], ty.List[ty.Tuple[ConferenceLoaderItem, ValidationError]]]:
+    """Rows of the valid items in a batch, and the invalid items with their errors"""
+    rows, invalid = [], []
+    for item in items:
+        try:
+            rows.append(item.to_row())
+        except ValidationError as err:
+            invalid.append((item, err))
+    return rows, invalid
 
-    @classmethod
-    def parse_keyword(cls, v) -> Keyword:
-        parts = v.split(":")
-        if len(parts) == 2:
-            return Keyword(type=parts[0].rstrip(), value=parts[1].lstrip())
-        return Keyword(type=None, value=parts[0])
 
-    def to_sqlmodel(self) -> ConferenceItem:
-        keywords = [self.parse_keyword(k) for k in set(self.get("keywords", []))]
-        authors = [Author(name=n) for n in set(self.get("authors", []))]
-        return ConferenceItem(
-            conference=self.get("conference"),
-            year=self.get("year"),
-            url=self.get("url"),
-            item_type=self.get("item_type"),
-            title=self.get("title"),
-            authors=authors,
-            keywords=keywords,
-            abstract=self.get("abstract"),
-            paper_url=self.get("paper_url"),
-            openreview_url=self.get("openreview_url"),
-            poster_url=self.get("poster_url"),
-            slides_url=self.get("slides_url")
-        )
+class ICMLLoaderItem(ConferenceLoaderItem):
+    # raw rendered page, stored by RenderedPagePipeline and not part of the sqlmodel
+    html: ty.Optional[bytes] = scrapy.Field(output_processor=TakeFirst())
 
 
-class AAAILoaderItem(scrapy.Item):
-    conference: str = scrapy.Field(output_processor=TakeFirst())
-    year: int = scrapy.Field(output_processor=TakeFirst())
-    url: ty.Optional[AnyUrl] = scrapy.Field(output_processor=TakeFirst())
-    item_type: ty.Optional[str] = scrapy.Field(input_processor=MapCompose(strip_space), output_processor=TakeFirst())
-    title: ty.Optional[str] = scrapy.Field(input_processor=MapCompose(strip_space), output_processor=TakeFirst())
-    authors: ty.Optional[ty.List[str]] = scrapy.Field(input_processor=MapCompose(strip_space, split_name))
-    keywords: ty.Optional[ty.List[str]] = scrapy.Field(input_processor=MapCompose(strip_space))
-    abstract: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    paper_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
+class NeurIPSLoaderItem(ConferenceLoaderItem):
     openreview_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
-    poster_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst()) 
-    slides_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
+    # raw rendered page, stored by RenderedPagePipeline and not part of the sqlmodel
+    html: ty.Optional[bytes] = scrapy.Field(output_processor=TakeFirst())
 
-    @classmethod
-    def parse_keyword(cls, v) -> Keyword:
-        parts = v.split(":")
-        if len(parts) == 2:
-            return Keyword(type=parts[0].rstrip(), value=parts[1].lstrip())
-        return Keyword(type=None, value=parts[0])
 
-    def to_sqlmodel(self) -> ConferenceItem:
-        keywords = [self.parse_keyword(k) for k in set(self.get("keywords", []))]
-        authors = [Author(name=n) for n in set(self.get("authors", []))]
-        return ConferenceItem(
-            conference=self.get("conference"),
-            year=self.get("year"),
-            url=self.get("url"),
-            item_type=self.get("item_type"),
-            title=self.get("title"),
-            authors=authors,
-            keywords=keywords,
-            abstract=self.get("abstract"),
-            paper_url=self.get("paper_url"),
-            openreview_url=self.get("openreview_url"),
-            poster_url=self.get("poster_url"),
-            slides_url=self.get("slides_url")
-        )
\ No newline at end of file
+class AAAILoaderItem(ConferenceLoaderItem):
+    openreview_url: ty.Optional[str] = scrapy.Field(output_processor=TakeFirst())
+
+
+# microbenchmark: items/sec of ItemLoader -> ConferenceItem(...) -> model.dict() against
+# ItemLoader -> validate_items, e.g. `python -m scraper.items 20000`
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from itemloaders import ItemLoader
+
+    from scraper.db import item_row
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    def load(i: int) -> NeurIPSLoaderItem:
+        loader = ItemLoader(item=NeurIPSLoaderItem())
+        loader.add_value("conference", "NeurIPS")
+        loader.add_value("year", 2022)
+        loader.add_value("url", f"https://neurips.cc/virtual/2022/poster/{i}")
+        loader.add_value("item_type", " Poster\n")
+        loader.add_value("title", f" Paper number {i} \n")
+        loader.add_value("authors", f"Author {i % 97},Author {i % 89},Author {i % 83}")
+        loader.add_value("keywords", ["Applications: Vision", "Theory", f"Topic: {i % 13}"])
+        loader.add_value("abstract", "An abstract. " * 50)
+        loader.add_value("paper_url", f"https://openreview.net/pdf?id={i}")
+        loader.add_value("openreview_url", f"https://openreview.net/forum?id={i}")
+        return loader.load_item()
+
+    def compared(row: ItemRow):
+        return row.columns(), set(row.authors), set(row.keywords)
+
+    def three_stage(items):
+        # what the pipelines and the upsert plan used to do per item
+        return [compared(item_row(item.to_sqlmodel())) for item in items]
+
+    def single_pass(items):
+        rows, _ = validate_items(items)
+        return [compared(row) for row in rows]
+
+    start = time.perf_counter()
+    items = [load(i) for i in range(n)]
+    loading = time.perf_counter() - start
+    print(f"ItemLoader: {n / loading:,.0f} items/s")
+    results = {}
+    for name, convert in (("three stage", three_stage), ("single pass", single_pass)):
+        start = time.perf_counter()
+        results[name] = convert(items)
+        seconds = time.perf_counter() - start
+        print(f"{name}: {n / seconds:,.0f} items/s validated, {n / (seconds + loading):,.0f} items/s with loading")
+    assert results["three stage"] == results["single pass"]
+    invalid = NeurIPSLoaderItem(conference="NeurIPS", url="not a url")
+    assert len(validate_items([invalid])[1]) == 1
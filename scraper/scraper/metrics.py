@@ -0,0 +1,322 @@
+"""
+metrics.py
+
+Per-stage crawl instrumentation, to tell which stage of a crawl is the bottleneck.
+Latencies are kept as histograms per spider, stage and request type:
+
+    download   request reaching the downloader -> response downloaded, by engine (splash,
+               playwright, http); the download slot's delay queue is included
+    parse      time spent in the spider callback, by engine of the request; for async
+               callbacks this is wall time, awaited page interactions included
+    validate   item -> row validation in the db pipelines, per item
+    db_write   one write transaction of a db pipeline, by what it writes (items, pages)
+
+together with gauges of the queue depths (scheduler, downloader, items being processed,
+the db pipelines' buffers and pending writes) and the rate of scraped items, sampled every
+STAGE_METRICS_INTERVAL seconds. StageMetrics serves all of it in the Prometheus text format
+on http://STAGE_METRICS_HOST:<port>/metrics (first free port of STAGE_METRICS_PORT, [] to
+not serve at all), and logs a summary sorted by total time when the spider closes.
+
+Stages are observed from the reactor thread only, so no locking is needed.
+"""
+import logging
+import time
+import typing as ty
+import weakref
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.reactor import listen_tcp
+from twisted.internet import task
+from twisted.web import resource, server
+
+from scraper.render import render_engine
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+HELP = {
+    "scraper_stage_seconds": ("histogram", "Latency of a crawl stage"),
+    "scraper_queue_depth": ("gauge", "Requests, responses or items waiting in a queue"),
+    "scraper_items_per_second": ("gauge", "Items scraped per second over the last sampling interval"),
+    "scraper_items_total": ("counter", "Items scraped"),
+}
+
+
+class Histogram:
+    """Fixed bucket histogram, bucket counts are per bucket (not cumulative)"""
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: ty.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float, n: int = 1):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += n
+        self.count += n
+        self.sum += value * n
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimated by interpolating within the bucket the quantile falls in"""
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        cumulative, lower = 0, 0.
+        for bound, n in zip(self.buckets, self.counts):
+            if n and cumulative + n >= rank:
+                return min(lower + (bound - lower) * (rank - cumulative) / n, self.max)
+            cumulative += n
+            lower = bound
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.
+
+
+Labels = ty.Tuple[ty.Tuple[str, str], ...]
+
+
+def _labels(labels: Labels) -> str:
+    def escape(v: str) -> str:
+        return v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return ",".join(f'{k}="{escape(str(v))}"' for k, v in labels)
+
+
+class StageRegistry:
+
+    def __init__(self, buckets: ty.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # (spider, stage, type) -> histogram
+        self.histograms: ty.Dict[ty.Tuple[str, str, str], Histogram] = {}
+        # (metric name, labels) -> value
+        self.gauges: ty.Dict[ty.Tuple[str, Labels], float] = {}
+
+    def observe(self, stage: str, spider: str, type_: str, seconds: float, n: int = 1):
+        key = (spider, stage, type_)
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds, n)
+
+    def set(self, name: str, value: float, **labels: str):
+        self.gauges[(name, tuple(labels.items()))] = value
+
+    def exposition(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = []
+        if self.histograms:
+            kind, help_ = HELP["scraper_stage_seconds"]
+            lines += [f"# HELP scraper_stage_seconds {help_}", f"# TYPE scraper_stage_seconds {kind}"]
+        for (spider, stage, type_), histogram in sorted(self.histograms.items()):
+            labels = _labels((("spider", spider), ("stage", stage), ("type", type_)))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'scraper_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"scraper_stage_seconds_sum{{{labels}}} {histogram.sum!r}")
+            lines.append(f"scraper_stage_seconds_count{{{labels}}} {histogram.count}")
+        for name in sorted({name for name, _ in self.gauges}):
+            kind, help_ = HELP.get(name, ("gauge", name))
+            lines += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+            for (n, labels), value in sorted(self.gauges.items()):
+                if n == name:
+                    lines.append(f"{name}{{{_labels(labels)}}} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, spider: str) -> ty.List[str]:
+        """Table of the spider's stages, the one that took the longest in total first"""
+        rows = sorted(
+            ((stage, type_, h) for (s, stage, type_), h in self.histograms.items() if s == spider),
+            key=lambda row: row[2].sum, reverse=True,
+        )
+        lines = [f"{'stage':<10} {'type':<12} {'count':>8} {'total':>10} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8}"]
+        for stage, type_, h in rows:
+            lines.append(
+                f"{stage:<10} {type_:<12} {h.count:>8} {h.sum:>10.2f} {h.mean:>8.3f} "
+                f"{h.quantile(.5):>8.3f} {h.quantile(.95):>8.3f} {h.max:>8.3f}"
+            )
+        return lines
+
+
+# the registry of the running crawl, set up by StageMetrics
+registry = StageRegistry()
+
+
+def observe(stage: str, spider: str, type_: str, seconds: float, n: int = 1):
+    """Record `n` observations of `seconds` for a stage, e.g. from a pipeline"""
+    registry.observe(stage, spider, type_, seconds, n)
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return registry.exposition().encode()
+
+
+class StageMetrics:
+    """
+    Extension: times downloads, samples queue depths and the item rate, serves the metrics
+    over http and summarises them when the spider closes. Callback time is recorded by
+    StageTimingMiddleware and validation/db time by the pipelines.
+    """
+
+    def __init__(self, crawler):
+        global registry
+        registry = StageRegistry()
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat("STAGE_METRICS_INTERVAL", 5.)
+        self.portrange = [int(p) for p in settings.getlist("STAGE_METRICS_PORT")]
+        self.host = settings.get("STAGE_METRICS_HOST", "127.0.0.1")
+        self.download_start: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.spider_name = None
+        self.port = None
+        self.sampler = None
+        self.items = 0
+        self.sampled = (time.monotonic(), 0)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("STAGE_METRICS_ENABLED", True):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(ext.request_left_downloader, signal=signals.request_left_downloader)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.spider_name = spider.name
+        self.sampled = (time.monotonic(), 0)
+        self.sampler = task.LoopingCall(self.sample)
+        self.sampler.start(self.interval, now=False)
+        if self.portrange:
+            self.port = listen_tcp(self.portrange, self.host, server.Site(MetricsResource()))
+            address = self.port.getHost()
+            logger.info(f"Serving stage metrics on http://{address.host}:{address.port}/metrics")
+
+    def request_reached_downloader(self, request, spider):
+        self.download_start[request] = time.perf_counter()
+
+    def response_downloaded(self, response, request, spider):
+        if (start := self.download_start.pop(request, None)) is not None:
+            observe("download", spider.name, render_engine(request) or "http", time.perf_counter() - start)
+
+    def request_left_downloader(self, request, spider):
+        # failed downloads never get a response
+        self.download_start.pop(request, None)
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def queue_depths(self) -> ty.Dict[str, int]:
+        engine = self.crawler.engine
+        if engine is None or engine.slot is None:
+            return {}
+        downloader, scraper = engine.downloader, engine.scraper
+        depths = {
+            "scheduler": len(engine.slot.scheduler),
+            "downloader": len(downloader.active),
+            "transferring": sum(len(slot.transferring) for slot in downloader.slots.values()),
+            "scraper": len(scraper.slot.active) if scraper.slot is not None else 0,
+            "item_pipeline": scraper.slot.itemproc_size if scraper.slot is not None else 0,
+        }
+        # pipelines with their own buffers or writers report them with a queue_depths() method
+        for pipeline in scraper.itemproc.middlewares:
+            if (pipeline_depths := getattr(pipeline, "queue_depths", None)) is not None:
+                for name, depth in pipeline_depths().items():
+                    depths[f"{type(pipeline).__name__}/{name}"] = depth
+        return depths
+
+    def sample(self):
+        for queue, depth in self.queue_depths().items():
+            registry.set("scraper_queue_depth", depth, spider=self.spider_name, queue=queue)
+        now = time.monotonic()
+        last, items = self.sampled
+        if now > last:
+            registry.set("scraper_items_per_second", (self.items - items) / (now - last), spider=self.spider_name)
+        registry.set("scraper_items_total", self.items, spider=self.spider_name)
+        self.sampled = (now, self.items)
+
+    def spider_closed(self, spider):
+        if self.sampler is not None and self.sampler.running:
+            self.sampler.stop()
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+        for (s, stage, type_), h in registry.histograms.items():
+            if s == spider.name:
+                prefix = f"stages/{stage}/{type_}"
+                self.stats.set_value(f"{prefix}/count", h.count)
+                self.stats.set_value(f"{prefix}/seconds", h.sum)
+                self.stats.set_value(f"{prefix}/p95", h.quantile(.95))
+                self.stats.set_value(f"{prefix}/max", h.max)
+        spider.logger.info("Stage timings (seconds), slowest stage first:\n" + "\n".join(registry.summary(spider.name)))
+
+
+class StageTimingMiddleware:
+    """
+    Spider middleware timing callbacks: the time spent producing each of the callback's
+    outputs, summed up once it's exhausted. Callbacks are generators (or async generators)
+    throughout, a callback returning a list did its work before it gets here and is timed
+    as ~0. Goes after the built-in spider middlewares, i.e. closest to the spider.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("STAGE_METRICS_ENABLED", True):
+            raise NotConfigured
+        return cls()
+
+    def observe(self, response, spider, seconds: float):
+        engine = render_engine(response.request) if response.request is not None else None
+        observe("parse", spider.name, engine or "http", seconds)
+
+    def process_spider_output(self, response, result, spider):
+        elapsed = 0.
+        it = iter(result)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    out = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield out
+        finally:
+            self.observe(response, spider, elapsed)
+
+    async def process_spider_output_async(self, response, result, spider):
+        elapsed = 0.
+        it = result.__aiter__()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    out = await it.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield out
+        finally:
+            self.observe(response, spider, elapsed)
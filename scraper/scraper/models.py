@@ -1,7 +1,8 @@
 
 import typing as ty
+from datetime import datetime
 
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import Index, UniqueConstraint, func
 from sqlmodel import SQLModel, Field, create_engine, Relationship
 from pydantic import AnyUrl, validator
 
@@ -26,7 +27,8 @@ class KeywordPubLink(SQLModel, table=True):
 
 class ConferenceItem(SQLModel, table=True):
     id: ty.Optional[int] = Field(default=None, primary_key=True)
-    url: AnyUrl
+    # natural key, a conference page is scraped into exactly one item
+    url: AnyUrl = Field(unique=True)
     title: str = Field(index=True, unique=False)
     item_type: ty.Optional[str] = Field(default=None, index=True)
     authors: ty.List["Author"] = Relationship(
@@ -46,7 +48,7 @@ class ConferenceItem(SQLModel, table=True):
 
 class Author(SQLModel, table=True):
     id: ty.Optional[int] = Field(default=None, primary_key=True)
-    name: str = Field(index=True)#, unique=True)
+    name: str = Field(index=True, unique=True)
 
     conference_items: ty.List[ConferenceItem] = Relationship(
         back_populates="authors", link_model=AuthorPubLink
@@ -54,11 +56,26 @@ class Author(SQLModel, table=True):
 
 
 class Keyword(SQLModel, table=True):
-    #__table_args__ = (UniqueConstraint("type", "value"),)
+    # uniqueness on (type, value) is enforced by an expression index below since
+    # type is nullable and NULLs never conflict in a plain UNIQUE constraint
     id: ty.Optional[int] = Field(default=None, primary_key=True)
     type: ty.Optional[str] = Field(index=True)
     value: str = Field(index=True)
 
     conference_items: ty.List[ConferenceItem] = Relationship(
         back_populates="keywords", link_model=KeywordPubLink
-    )
\ No newline at end of file
+    )
+
+
+# natural key for keywords, ON CONFLICT clauses must target these exact expressions
+keyword_natural_key = (func.coalesce(Keyword.type, ""), Keyword.value)
+Index("uq_keyword_type_value", *keyword_natural_key, unique=True)
+
+
+class RenderedPage(SQLModel, table=True):
+    # zlib-compressed html each item was extracted from, so that items can be
+    # re-extracted without re-rendering (see scraper/replay.py)
+    url: str = Field(primary_key=True)
+    spider: str = Field(index=True)
+    body: bytes
+    fetched_at: datetime = Field(default_factory=datetime.utcnow)
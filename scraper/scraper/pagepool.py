@@ -0,0 +1,302 @@
+"""
+pagepool.py
+
+Playwright page pool on top of scrapy-playwright. Instead of opening a page for every
+request that hands its page to the callback (playwright_include_page) and closing it
+afterwards, callbacks return their page to the pool and the next request for the same
+context navigates that page. Pages are recycled (closed, and replaced by a fresh one
+on demand) once they reach PAGEPOOL_MAX_AGE seconds or PAGEPOOL_MAX_NAVIGATIONS
+navigations, so long crawls run with bounded browser memory.
+
+Callbacks lease their page with
+
+    async with leased_page(response) as page:
+        ...
+
+which returns it to the pool when the block is left normally and closes it when it is
+left with an exception (the page may be in any state). Pages leased for longer than
+PAGEPOOL_LEASE_TIMEOUT (or the request's `pagepool_lease_timeout` meta, None for no
+limit) are considered leaked and closed by a periodic sweep. Open, leased and idle
+pages and the contexts they belong to are reported as `pagepool/*` gauges in the stats.
+
+Arguments of the browser contexts (e.g. the storage state of a logged in session) are
+registered by context name in `pool.context_kwargs` rather than put in the request meta
+as `playwright_context_kwargs`, so that they never end up in the JOBDIR with the pending
+requests. They are added to the meta of a request only while it is being downloaded.
+"""
+import contextlib
+import logging
+import time
+import typing as ty
+from dataclasses import dataclass, field
+
+from playwright.async_api import Page
+from scrapy import signals
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import task
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PooledPage:
+    page: Page
+    context: str
+    created: float = field(default_factory=time.monotonic)
+    navigations: int = 0
+    # lease start and limit, None while idle
+    leased_at: ty.Optional[float] = None
+    lease_timeout: ty.Optional[float] = None
+    # page event handlers the lease's request attached, detached when it's returned
+    handlers: ty.Dict[str, ty.Any] = field(default_factory=dict)
+
+
+class PagePool:
+
+    def __init__(self, max_age: float = 600., max_navigations: int = 50, lease_timeout: ty.Optional[float] = 600.,
+                 stats=None):
+        self.max_age = max_age
+        self.max_navigations = max_navigations
+        self.lease_timeout = lease_timeout
+        self.stats = stats
+        self.pages: ty.Dict[Page, PooledPage] = {}
+        # context -> its idle pages, most recently returned last
+        self.idle: ty.Dict[str, ty.List[PooledPage]] = {}
+        self.retired: ty.Set[str] = set()
+        # context -> playwright_context_kwargs it is created with
+        self.context_kwargs: ty.Dict[str, ty.Dict[str, ty.Any]] = {}
+
+    def expired(self, pooled: PooledPage) -> bool:
+        return (
+            pooled.page.is_closed()
+            or pooled.context in self.retired
+            or time.monotonic() - pooled.created > self.max_age
+            or pooled.navigations >= self.max_navigations
+        )
+
+    def lease(self, context: str, lease_timeout: ty.Optional[float] = None) -> ty.Optional[Page]:
+        """An idle page of `context` still fit for use, None if a new page has to be opened"""
+        idle = self.idle.get(context, [])
+        while idle:
+            pooled = idle.pop()
+            if self.expired(pooled):
+                self._forget(pooled)
+                continue
+            pooled.leased_at = time.monotonic()
+            pooled.lease_timeout = lease_timeout
+            self.inc("pagepool/reused")
+            self.update_gauges()
+            return pooled.page
+        return None
+
+    def track(self, page: Page, context: str, handlers: ty.Optional[ty.Dict[str, ty.Any]] = None,
+              lease_timeout: ty.Optional[float] = None):
+        """Register a page handed to a callback, new or leased"""
+        pooled = self.pages.get(page)
+        if pooled is None:
+            pooled = self.pages[page] = PooledPage(page, context, leased_at=time.monotonic(), lease_timeout=lease_timeout)
+            page.on("framenavigated", lambda frame: frame == page.main_frame and self._navigated(pooled))
+            page.on("close", lambda _: self._forget(pooled))
+            self.inc("pagepool/created")
+        pooled.handlers = dict(handlers or {})
+        self.update_gauges()
+
+    def _navigated(self, pooled: PooledPage):
+        pooled.navigations += 1
+
+    def _forget(self, pooled: PooledPage):
+        self.pages.pop(pooled.page, None)
+        idle = self.idle.get(pooled.context, [])
+        if pooled in idle:
+            idle.remove(pooled)
+        self.update_gauges()
+
+    async def release(self, page: Page):
+        """Return a leased page, closed instead if it's due for recycling"""
+        pooled = self.pages.get(page)
+        if pooled is None:
+            if not page.is_closed():
+                await page.close()
+            return
+        for event, handler in pooled.handlers.items():
+            try:
+                page.remove_listener(event, handler)
+            except Exception:
+                logger.debug(f"Could not remove {event} handler {handler} from {page}")
+        pooled.handlers = {}
+        pooled.leased_at = None
+        if self.expired(pooled):
+            self.inc("pagepool/recycled")
+            await self.discard(page)
+        else:
+            self.idle.setdefault(pooled.context, []).append(pooled)
+            self.update_gauges()
+        await self.close_retired()
+
+    async def discard(self, page: Page):
+        """Close a page for good"""
+        pooled = self.pages.get(page)
+        if pooled is not None:
+            self._forget(pooled)
+        if not page.is_closed():
+            await page.close()
+
+    async def retire(self, predicate: ty.Callable[[str], bool]):
+        """
+        Stop handing out pages of the contexts `predicate` accepts (e.g. those of an expired
+        session), close their idle pages now and the contexts once no page of theirs is leased
+        """
+        self.retired.update(p.context for p in self.pages.values() if predicate(p.context))
+        await self.close_retired()
+
+    async def close_retired(self):
+        for context in list(self.retired):
+            pages = [p for p in self.pages.values() if p.context == context]
+            if any(p.leased_at is not None for p in pages):
+                continue
+            self.retired.discard(context)
+            if pages:
+                browser_context = pages[0].page.context
+                for pooled in pages:
+                    await self.discard(pooled.page)
+                await browser_context.close()
+                self.inc("pagepool/contexts_closed")
+
+    async def sweep(self):
+        """Recycle expired idle pages and close leaked ones"""
+        now = time.monotonic()
+        for pooled in list(self.pages.values()):
+            if pooled.leased_at is None:
+                if self.expired(pooled):
+                    self.inc("pagepool/recycled")
+                    await self.discard(pooled.page)
+            elif pooled.lease_timeout is not None and now - pooled.leased_at > pooled.lease_timeout:
+                logger.warning(f"Closing page leaked by its callback for {now - pooled.leased_at:.0f}s: {pooled.page.url}")
+                self.inc("pagepool/leaked")
+                await self.discard(pooled.page)
+        await self.close_retired()
+        self.update_gauges()
+
+    def inc(self, key: str, count: int = 1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
+
+    def update_gauges(self):
+        if self.stats is None:
+            return
+        leased = sum(p.leased_at is not None for p in self.pages.values())
+        self.stats.set_value("pagepool/open_pages", len(self.pages))
+        self.stats.set_value("pagepool/leased_pages", leased)
+        self.stats.set_value("pagepool/idle_pages", len(self.pages) - leased)
+        self.stats.set_value("pagepool/contexts", len({p.context for p in self.pages.values()}))
+        self.stats.max_value("pagepool/max_open_pages", len(self.pages))
+
+
+# the pool of the running crawl, set up by PagePoolMiddleware
+pool = PagePool()
+
+
+@contextlib.asynccontextmanager
+async def leased_page(response) -> ty.AsyncIterator[Page]:
+    """The page of a playwright_include_page response, returned to the pool (or closed on error) afterwards"""
+    page = response.meta["playwright_page"]
+    try:
+        yield page
+    except BaseException:
+        await pool.discard(page)
+        raise
+    else:
+        await pool.release(page)
+
+
+class PagePoolMiddleware:
+    """
+    Downloader middleware: hands pooled pages to playwright_include_page requests and
+    registers the pages of their responses. Requests opt out with `pagepool: False` meta.
+    Also sets the registered playwright_context_kwargs of the requests' contexts.
+    """
+
+    def __init__(self, crawler):
+        global pool
+        settings = crawler.settings
+        lease_timeout = settings.getfloat("PAGEPOOL_LEASE_TIMEOUT", 600.)
+        pool = PagePool(
+            max_age=settings.getfloat("PAGEPOOL_MAX_AGE", 600.),
+            max_navigations=settings.getint("PAGEPOOL_MAX_NAVIGATIONS", 50),
+            lease_timeout=lease_timeout if lease_timeout > 0 else None,
+            stats=crawler.stats,
+        )
+        self.sweep_interval = settings.getfloat("PAGEPOOL_SWEEP_INTERVAL", 30.)
+        self.sweeper = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mw = cls(crawler)
+        crawler.signals.connect(mw.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def spider_opened(self, spider):
+        self.sweeper = task.LoopingCall(self.sweep)
+        self.sweeper.start(self.sweep_interval, now=False)
+
+    def sweep(self):
+        d = deferred_from_coro(pool.sweep())
+        # a failed sweep mustn't stop the looping call
+        d.addErrback(lambda failure: logger.error(f"Page pool sweep failed: {failure.value!r}"))
+        return d
+
+    def spider_closed(self, spider):
+        if self.sweeper is not None and self.sweeper.running:
+            self.sweeper.stop()
+        leased = [p.page.url for p in pool.pages.values() if p.leased_at is not None]
+        if leased:
+            spider.logger.warning(f"{len(leased)} pages were never returned to the pool: {leased[:10]}")
+
+    @staticmethod
+    def pooled(request) -> bool:
+        meta = request.meta
+        return bool(meta.get("playwright") and meta.get("playwright_include_page") and meta.get("pagepool", True))
+
+    def lease_timeout(self, request) -> ty.Optional[float]:
+        return request.meta.get("pagepool_lease_timeout", pool.lease_timeout)
+
+    @staticmethod
+    def context(request) -> str:
+        return request.meta.get("playwright_context", "default")
+
+    @classmethod
+    def strip_context_kwargs(cls, request):
+        # so that retries (RetryMiddleware, errbacks) don't queue them
+        kwargs = pool.context_kwargs.get(cls.context(request))
+        if kwargs is not None and request.meta.get("playwright_context_kwargs") is kwargs:
+            del request.meta["playwright_context_kwargs"]
+
+    def process_request(self, request, spider):
+        if request.meta.get("playwright") and self.context(request) in pool.context_kwargs:
+            request.meta.setdefault("playwright_context_kwargs", pool.context_kwargs[self.context(request)])
+        if not self.pooled(request) or request.meta.get("playwright_page") is not None:
+            return None
+        page = pool.lease(self.context(request), self.lease_timeout(request))
+        if page is not None:
+            request.meta["playwright_page"] = page
+        return None
+
+    def process_response(self, request, response, spider):
+        self.strip_context_kwargs(request)
+        page = response.meta.get("playwright_page")
+        if self.pooled(request) and page is not None:
+            pool.track(
+                page, self.context(request),
+                handlers={
+                    event: getattr(spider, h) if isinstance(h, str) else h
+                    for event, h in (request.meta.get("playwright_page_event_handlers") or {}).items()
+                },
+                lease_timeout=self.lease_timeout(request),
+            )
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.strip_context_kwargs(request)
+        return None
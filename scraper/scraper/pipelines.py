@@ -4,96 +4,492 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 import asyncio
 import logging
+import time
+import typing as ty
+import zlib
 # useful for handling different item types with a single interface
-from collections import defaultdict
 #from itemadapter import ItemAdapter
 from pydantic import ValidationError
+from scrapy.utils.defer import deferred_from_coro, maybe_deferred_to_future
+from sqlalchemy.exc import DBAPIError
 from sqlmodel import Session
 from sqlmodel.ext.asyncio.session import AsyncSession
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
 from scraper.settings import get_settings
-from scraper.db import SQLModel, create_db_and_tables, engine, async_engine, ConferenceItem, Keyword, Author, get_or_create, async_get_or_create
+from scraper.identity import IdentityMap
+from scraper.items import validate_items
+from scraper.metrics import observe
+from scraper.db import create_db_and_tables, get_engine, get_async_engine, dispose_engine, async_dispose_engine, pool_stats, bulk_insert_items, async_bulk_insert_items, page_upsert, ItemRow
 
 
 logger = logging.getLogger(__name__)
 
 
-class SQLModelItemPipeline:
+def report_identity_stats(identity: IdentityMap, stats):
+    for k, v in identity.stats().items():
+        stats.set_value(f"identity_map/{k}", v)
+    logger.info(f"Identity map stats: {identity.stats()}")
+
+
+def report_pool_stats(stats):
+    for k, v in pool_stats().items():
+        stats.set_value(f"db_pool/{k}", v)
+    logger.info(f"Connection pool stats: {pool_stats()}")
+
+
+def skip_invalid(item, err: ValidationError, stats, spider=None):
+    logger.error("Skipping item, encountered validation error with details: ")
+    logger.error(err)
+    logger.error(item)
+    stats.inc_value("sqlmodel/items_invalid")
+    # would be just as invalid when scraped again
+    report_failed(spider, [str(item.get("url"))], f"invalid item: {err}", final=True)
+
+
+def report_persisted(spider, rows: ty.Sequence[ItemRow]):
+    """Tell a resumable spider (see scraper.crawlstate) which items are committed"""
+    if (persisted := getattr(spider, "persisted", None)) is not None:
+        persisted([row.url for row in rows])
+
+
+def report_failed(spider, urls: ty.Sequence[str], error: str, final: bool = False):
+    """Tell a resumable spider which items won't be written, see ResumableSpider.failed"""
+    if (failed := getattr(spider, "failed", None)) is not None:
+        failed(urls, error, final=final)
+
+
+class WriterThreads:
+    """
+    Runs a pipeline's blocking db work on its own bounded pool of writer threads instead
+    of the reactor thread, with stats only ever touched from the reactor thread.
+
+    Scrapy closes the pipelines concurrently, so the sync engine they share is disposed
+    by the last one to stop its writers, once every flush is done.
+    """
+    writer_threads: int = 1
+    threadpool: ty.Optional[ThreadPool] = None
+    # pipelines whose writers are started, across every WriterThreads subclass
+    running: int = 0
+
+    def start_writers(self):
+        WriterThreads.running += 1
+        # writes in flight, waited for on close
+        self.pending = set()
+        if self.writer_threads > 0:
+            self.threadpool = ThreadPool(minthreads=1, maxthreads=self.writer_threads, name=f"{type(self).__name__}-writer")
+            self.threadpool.start()
+            logger.info(f"Started {self.writer_threads} db writer threads for {type(self).__name__}")
+
+    def run(self, f, *args) -> defer.Deferred:
+        """Run the blocking db work `f(*args)` on the writer threads, or inline without any"""
+        if self.threadpool is None:
+            return defer.maybeDeferred(f, *args)
+        # not imported at module level, which would install the default reactor before
+        # e.g. scraper.replay creates its Crawler
+        from twisted.internet import reactor
+        d = deferToThreadPool(reactor, self.threadpool, f, *args)
+        self.pending.add(d)
+
+        def done(result):
+            self.pending.discard(d)
+            return result
+
+        return d.addBoth(done)
+
+    def queue_depths(self) -> ty.Dict[str, int]:
+        """Writes handed to the writer threads and not done yet, see scraper.metrics"""
+        return {"pending_writes": len(self.pending)}
+
+    async def stop_writers(self):
+        """Wait until every write handed to the writer threads so far is done, then stop them"""
+        while self.pending:
+            await maybe_deferred_to_future(defer.DeferredList(list(self.pending), consumeErrors=True))
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+        WriterThreads.running -= 1
+        if not WriterThreads.running:
+            dispose_engine()
+
+
+class RenderedPagePipeline(WriterThreads):
+    """
+    Takes the raw html spiders attach to their items (the `html` field), and stores it
+    zlib-compressed in the renderedpage table keyed by the item url, in batches of
+    SQLMODEL_BATCH_SIZE written on a writer thread. The html is dropped from the item
+    before it is passed on. Disabled with STORE_RENDERED_PAGES = False.
+    """
+
+    def __init__(self, stats, batch_size: int = 200, enabled: bool = True, compression_level: int = 6,
+                 writer_threads: int = 1):
+        self.stats = stats
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.compression_level = compression_level
+        self.writer_threads = writer_threads
+        self.buffer = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            stats=crawler.stats,
+            batch_size=crawler.settings.getint("SQLMODEL_BATCH_SIZE", 200),
+            enabled=crawler.settings.getbool("STORE_RENDERED_PAGES", True),
+            compression_level=crawler.settings.getint("RENDERCACHE_COMPRESSION_LEVEL", 6),
+            # one thread at most, so that batches of the same url land in order
+            writer_threads=min(1, crawler.settings.getint("SQLMODEL_WRITER_THREADS", 1)),
+        )
+
+    def open_spider(self, spider):
+        self.spider_name = spider.name
+        create_db_and_tables()
+        self.start_writers()
+
+    def close_spider(self, spider):
+        return deferred_from_coro(self.close())
+
+    async def close(self):
+        await maybe_deferred_to_future(self.flush())
+        await self.stop_writers()
+
+    def process_item(self, item, spider):
+        html = item.pop("html", None)
+        if self.enabled and html is not None and item.get("url"):
+            body = zlib.compress(html, self.compression_level)
+            self.buffer.append(dict(url=str(item["url"]), spider=spider.name, body=body))
+            self.stats.inc_value("rendered_pages/raw_bytes", len(html))
+            self.stats.inc_value("rendered_pages/stored_bytes", len(body))
+            if len(self.buffer) >= self.batch_size:
+                return self.flush().addCallback(lambda _: item)
+        return item
+
+    def flush(self) -> defer.Deferred:
+        if not self.buffer:
+            return defer.succeed(None)
+        # the last render of a url wins, and a statement can't update the same row twice
+        batch = list({row["url"]: row for row in self.buffer}.values())
+        self.buffer = []
+        return self.run(self.write_batch, batch).addCallbacks(
+            self.flushed, self.flush_failed, callbackArgs=(batch,), errbackArgs=(batch,)
+        )
+
+    def write_batch(self, batch):
+        start = time.perf_counter()
+        with Session(get_engine()) as session, session.begin():
+            session.execute(page_upsert(batch))
+        return time.perf_counter() - start
+
+    def flush_failed(self, failure, batch):
+        logger.error(f"Failed to store {len(batch)} rendered pages")
+        logger.error(failure.getTraceback())
+        self.stats.inc_value("rendered_pages/dropped", len(batch))
+
+    def queue_depths(self) -> ty.Dict[str, int]:
+        return {**super().queue_depths(), "buffer": len(self.buffer)}
+
+    def flushed(self, latency, batch):
+        observe("db_write", self.spider_name, "pages", latency)
+        self.stats.inc_value("rendered_pages/stored", len(batch))
+        logger.info(f"Stored {len(batch)} rendered pages")
+
+
+class SQLModelItemPipeline(WriterThreads):
+    """
+    Upserts every item in its own transaction. The blocking db work runs on a dedicated
+    pool of SQLMODEL_WRITER_THREADS threads so that it doesn't stall the reactor, and
+    process_item returns a Deferred firing once the item is written. With a single
+    writer thread (the default) items are written in the order they were scraped, with
+    0 everything runs inline on the reactor thread as it used to.
+    """
+    # committed items are reported to the spider's `persisted`
+    reports_persisted = True
+
+    def __init__(self, stats, identity_cache_size: int = 50_000, writer_threads: int = 1):
+        self.stats = stats
+        self.identity = IdentityMap(maxsize=identity_cache_size)
+        self.writer_threads = writer_threads
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            stats=crawler.stats,
+            identity_cache_size=crawler.settings.getint("SQLMODEL_IDENTITY_CACHE_SIZE", 50_000),
+            writer_threads=crawler.settings.getint("SQLMODEL_WRITER_THREADS", 1),
+        )
 
     def open_spider(self, spider):
+        self.spider = spider
+        self.spider_name = spider.name
         self.settings = get_settings()
         logger.info("Creating tables")
         create_db_and_tables()
+        with Session(get_engine()) as session:
+            self.identity.warm(session)
+        self.start_writers()
 
     def close_spider(self, spider):
-        pass
+        return deferred_from_coro(self.close())
+
+    async def close(self):
+        await self.stop_writers()
+        report_identity_stats(self.identity, self.stats)
+        report_pool_stats(self.stats)
 
     def validate_item(self, item):
-        # validate item
+        # validate item, once, into the row bulk_insert_items writes
         try:
-            return item.to_sqlmodel()
+            return item.to_row()
         except ValidationError as err:
-            logger.error("Skipping item, encountered validation error with details: ")
-            logger.error(err)
-            logger.error(item)
+            skip_invalid(item, err, self.stats, self.spider)
+
+    def write_item(self, row):
+        start = time.perf_counter()
+        with Session(get_engine()) as session:
+            logger.info("Adding item to database")
+            # upserts on the natural keys ensure we don't duplicate entries
+            with session.begin():
+                plan = bulk_insert_items([row], session, cache=self.identity)
+            plan.remember()
+            logger.info("Item added successfully")
+        return time.perf_counter() - start
+
+    def written(self, latency, row, item):
+        observe("db_write", self.spider_name, "items", latency)
+        report_persisted(self.spider, [row])
+        return item
 
     def process_item(self, item, spider):
-        item = self.validate_item(item)
-        if item is not None:
-            with Session(engine) as session:
-                logger.info("Adding item to database")
-                # ensure we don't duplicate entries
-                authors = [get_or_create(a, session) for a in item.authors]
-                keywords = [get_or_create(k, session) for k in item.keywords]
-                item = get_or_create(item, session)
-                item.authors = authors
-                item.keywords = keywords
-                session.add(item)
-                session.commit()
-                session.refresh(item)
-                logger.info("Item added successfully")
+        start = time.perf_counter()
+        row = self.validate_item(item)
+        observe("validate", spider.name, "item", time.perf_counter() - start)
+        if row is None:
+            return item
+        return self.run(self.write_item, row).addCallback(self.written, row, item)
+
+
+class BatchedSQLModelItemPipeline(SQLModelItemPipeline):
+    """
+    Buffers items and writes them with multi-row INSERTs, one transaction per batch of
+    SQLMODEL_BATCH_SIZE items, on the writer threads, which also validate the batch (see
+    validate_items). Whatever is left is flushed on close, after the batches still being
+    written.
+    """
+
+    def __init__(self, stats, batch_size: int = 200, identity_cache_size: int = 50_000, writer_threads: int = 1):
+        super().__init__(stats, identity_cache_size=identity_cache_size, writer_threads=writer_threads)
+        self.batch_size = batch_size
+        self.buffer = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            stats=crawler.stats,
+            batch_size=crawler.settings.getint("SQLMODEL_BATCH_SIZE", 200),
+            identity_cache_size=crawler.settings.getint("SQLMODEL_IDENTITY_CACHE_SIZE", 50_000),
+            writer_threads=crawler.settings.getint("SQLMODEL_WRITER_THREADS", 1),
+        )
+
+    async def close(self):
+        await maybe_deferred_to_future(self.flush())
+        await super().close()
+
+    def process_item(self, item, spider):
+        # validated a batch at a time on the writer thread, see write_batch
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch_size:
+            # the item that filled the batch waits for it, which holds the crawl
+            # back (CONCURRENT_ITEMS) when the writers can't keep up
+            return self.flush().addCallback(lambda _: item)
         return item
 
+    def flush(self) -> defer.Deferred:
+        if not self.buffer:
+            return defer.succeed(None)
+        batch, self.buffer = self.buffer, []
+        logger.info(f"Flushing {len(batch)} items to database")
+        d = self.run(self.write_batch, batch)
+        # stats are only touched from the reactor thread
+        return d.addCallbacks(self.flushed, self.flush_failed, callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def write_batch(self, batch):
+        start = time.perf_counter()
+        rows, invalid = validate_items(batch)
+        validation = time.perf_counter() - start
+        start = time.perf_counter()
+        with Session(get_engine()) as session, session.begin():
+            plan = bulk_insert_items(rows, session, cache=self.identity)
+        latency = time.perf_counter() - start
+        plan.remember()
+        return plan, latency, rows, invalid, validation
+
+    def queue_depths(self) -> ty.Dict[str, int]:
+        return {**super().queue_depths(), "buffer": len(self.buffer)}
+
+    def flush_failed(self, failure, batch):
+        logger.error(f"Failed to flush batch of {len(batch)} items")
+        logger.error(failure.getTraceback())
+        self.stats.inc_value("sqlmodel/flush_errors")
+        self.stats.inc_value("sqlmodel/items_dropped", len(batch))
+        report_failed(self.spider, [str(item.get("url")) for item in batch], repr(failure.value))
+
+    def flushed(self, result, batch):
+        plan, latency, rows, invalid, validation = result
+        # validated a batch at a time, each item is observed at the batch average
+        observe("validate", self.spider_name, "item", validation / len(batch), n=len(batch))
+        observe("db_write", self.spider_name, "items", latency)
+        for item, err in invalid:
+            skip_invalid(item, err, self.stats, self.spider)
+        report_persisted(self.spider, rows)
+        self.stats.inc_value("sqlmodel/flush_count")
+        self.stats.inc_value("sqlmodel/items_flushed", len(rows))
+        self.stats.inc_value("sqlmodel/rows_inserted", plan.n_rows)
+        self.stats.inc_value("sqlmodel/flush_time", latency, start=0.)
+        self.stats.max_value("sqlmodel/flush_latency_max", latency)
+        self.stats.set_value(
+            "sqlmodel/rows_per_sec",
+            self.stats.get_value("sqlmodel/rows_inserted") / self.stats.get_value("sqlmodel/flush_time")
+        )
+        logger.info(f"Flushed {plan.n_rows} rows in {latency:.3f}s")
 
 
 class AsyncSQLModelItemPipeline:
+    """
+    Validated items go on a bounded queue drained by SQLMODEL_ASYNC_WRITERS writer tasks,
+    each upserting whatever is queued (up to SQLMODEL_BATCH_SIZE items) in one transaction
+    on its own pooled async engine connection, so no connection is ever shared between
+    tasks (https://github.com/MagicStack/asyncpg/issues/863).
+
+    When the queue is full process_item waits for a slot and the engine is paused until
+    the writers have caught up, which holds the crawl back instead of buffering without
+    bound.
+    """
+    # committed items are reported to the spider's `persisted`
+    reports_persisted = True
+
+    def __init__(self, crawler, identity_cache_size: int = 50_000, writers: int = 4, queue_size: int = 500, batch_size: int = 200, retries: int = 2):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.identity = IdentityMap(maxsize=identity_cache_size)
+        self.n_writers = writers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.retries = retries
+        self.writers = []
+        self.paused = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            crawler,
+            identity_cache_size=crawler.settings.getint("SQLMODEL_IDENTITY_CACHE_SIZE", 50_000),
+            writers=crawler.settings.getint("SQLMODEL_ASYNC_WRITERS", 4),
+            queue_size=crawler.settings.getint("SQLMODEL_WRITE_QUEUE_SIZE", 500),
+            batch_size=crawler.settings.getint("SQLMODEL_BATCH_SIZE", 200),
+        )
 
     def open_spider(self, spider):
+        self.spider = spider
+        self.spider_name = spider.name
         self.settings = get_settings()
         logger.info("Creating tables")
         create_db_and_tables()
+        with Session(get_engine()) as session:
+            self.identity.warm(session)
+        # only needed at startup, the writers use the async engine
+        dispose_engine()
+        if self.n_writers > self.settings.db_pool_size + self.settings.db_max_overflow:
+            logger.warning(f"{self.n_writers} writers will queue for {self.settings.db_pool_size + self.settings.db_max_overflow} pooled connections")
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.writers = [
+            asyncio.ensure_future(self.writer(i)) for i in range(self.n_writers)
+        ]
+        logger.info(f"Started {self.n_writers} db writer tasks")
 
     def close_spider(self, spider):
-        pass
+        return deferred_from_coro(self.close())
+
+    async def close(self):
+        # everything queued is written before the writers are stopped
+        await self.queue.join()
+        for writer in self.writers:
+            writer.cancel()
+        await asyncio.gather(*self.writers, return_exceptions=True)
+        report_identity_stats(self.identity, self.stats)
+        report_pool_stats(self.stats)
+        await async_dispose_engine()
 
     def validate_item(self, item):
-        # validate item
+        # validate item, once, into the row bulk_insert_items writes
         try:
-            return item.to_sqlmodel()
+            return item.to_row()
         except ValidationError as err:
-            logger.error("Skipping item, encountered validation error with details: ")
-            logger.error(err)
-            logger.error(item)
+            skip_invalid(item, err, self.stats, self.spider)
+
+    def queue_depths(self) -> ty.Dict[str, int]:
+        """Validated items waiting for a writer, see scraper.metrics"""
+        return {"write_queue": self.queue.qsize()} if self.writers else {}
 
     async def process_item(self, item, spider):
-        item = self.validate_item(item)
-        logger.info("Item to be inserted:")
-        logger.info(item)
-        if item is not None:
-            async with AsyncSession(async_engine) as session:
-                logger.info("Adding item to database")
-                # ensure we don't duplicate entries
-                # https://github.com/MagicStack/asyncpg/issues/863
-                #authors = await asyncio.gather(*[async_get_or_create(a, session) for a in item.authors])
-                #keywords = await asyncio.gather(*[async_get_or_create(k, session) for k in item.keywords])
-                item = await async_get_or_create(item, session)
-                logger.info("Item after get_or_create:")
-                logger.info(item)
-                #item = ConferenceItem.from_orm(item)
-                #item.authors = authors
-                #item.keywords = keywords
-                session.add(item)
-                await session.commit()
-                await session.refresh(item)
-                logger.info("Item added successfully")
-        return item
\ No newline at end of file
+        start = time.perf_counter()
+        row = self.validate_item(item)
+        observe("validate", spider.name, "item", time.perf_counter() - start)
+        if row is not None:
+            if self.queue.full():
+                self.stats.inc_value("sqlmodel/backpressure_waits")
+                if not self.paused:
+                    logger.info("Write queue full, pausing engine until the db writers catch up")
+                    self.paused = True
+                    self.crawler.engine.pause()
+            await self.queue.put(row)
+            self.stats.max_value("sqlmodel/write_queue_max", self.queue.qsize())
+        return item
+
+    async def writer(self, n: int):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.write(batch, n)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if self.paused and self.queue.qsize() <= self.queue_size // 2:
+                logger.info("Write queue drained, resuming engine")
+                self.paused = False
+                self.crawler.engine.unpause()
+
+    async def write(self, batch, n: int):
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                async with AsyncSession(get_async_engine()) as session, session.begin():
+                    plan = await async_bulk_insert_items(batch, session, cache=self.identity)
+            except DBAPIError as err:
+                # deadlocks/serialization failures between writers are worth a retry
+                logger.warning(f"Writer {n} failed to write {len(batch)} items (attempt {attempt + 1})")
+                logger.warning(err)
+                self.stats.inc_value("sqlmodel/flush_retries")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+                continue
+            except Exception as err:
+                logger.error(f"Writer {n} failed to write {len(batch)} items")
+                logger.exception(err)
+                break
+            latency = time.perf_counter() - start
+            plan.remember()
+            observe("db_write", self.spider_name, "items", latency)
+            report_persisted(self.spider, batch)
+            self.stats.inc_value("sqlmodel/flush_count")
+            self.stats.inc_value("sqlmodel/items_flushed", len(batch))
+            self.stats.inc_value("sqlmodel/rows_inserted", plan.n_rows)
+            self.stats.inc_value("sqlmodel/flush_time", latency, start=0.)
+            self.stats.max_value("sqlmodel/flush_latency_max", latency)
+            logger.info(f"Writer {n} wrote {plan.n_rows} rows for {len(batch)} items in {latency:.3f}s")
+            return
+        self.stats.inc_value("sqlmodel/flush_errors")
+        self.stats.inc_value("sqlmodel/items_dropped", len(batch))
+        report_failed(self.spider, [row.url for row in batch], "write failed")
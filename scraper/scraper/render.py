@@ -0,0 +1,250 @@
+"""
+render.py
+
+Render profiles: what the Playwright and Splash render paths may load. The default
+`light` profile aborts images, media, fonts and known analytics/tracking requests in
+Playwright (PLAYWRIGHT_ABORT_REQUEST) and has Splash skip images and give up on slow
+resources, `full` loads everything. Pick one with RENDER_PROFILE, or override parts of
+it with RENDER_BLOCK_RESOURCE_TYPES / RENDER_BLOCK_URL_PATTERNS / RENDER_SPLASH_FILTERS.
+
+RenderProfileMiddleware also records, per rendered page, the time to render and (for
+Playwright) the bytes and number of requests the page needed, under
+`render/<profile>/<engine>/*` in the stats, so profiles can be compared run by run.
+
+Screenshots are for debugging only: debug_screenshot takes them when RENDER_SCREENSHOTS
+is on, for a RENDER_SCREENSHOT_SAMPLE fraction of the calls.
+"""
+import functools
+import logging
+import random
+import re
+import time
+import typing as ty
+import weakref
+from dataclasses import dataclass
+from pathlib import Path
+
+import pydantic
+from scrapy import signals
+
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _url_re(patterns: ty.Tuple[str, ...]) -> ty.Optional[ty.Pattern]:
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+
+class RenderProfile(pydantic.BaseModel):
+    name: str
+    # Playwright resource types: document, stylesheet, image, media, font, script, xhr, fetch, ...
+    blocked_resource_types: ty.FrozenSet[str] = frozenset()
+    blocked_url_patterns: ty.List[str] = []
+    # Splash: seconds before a single resource is given up on, whether to load images,
+    # and adblock filter names known to the Splash server (--filters-path)
+    splash_resource_timeout: ty.Optional[float] = None
+    splash_images: bool = True
+    splash_filters: ty.Optional[str] = None
+
+    def blocks(self, resource_type: str, url: str) -> bool:
+        if resource_type in self.blocked_resource_types:
+            return True
+        pattern = _url_re(tuple(self.blocked_url_patterns))
+        return pattern is not None and pattern.search(url) is not None
+
+    def splash_args(self) -> ty.Dict[str, ty.Any]:
+        args = {"images": int(self.splash_images)}
+        if self.splash_resource_timeout is not None:
+            args["resource_timeout"] = self.splash_resource_timeout
+        if self.splash_filters:
+            args["filters"] = self.splash_filters
+        return args
+
+
+TRACKER_PATTERNS = [
+    r"google-analytics\.com", r"googletagmanager\.com", r"doubleclick\.net", r"connect\.facebook\.net",
+    r"hotjar\.com", r"segment\.(io|com)", r"sentry\.io", r"intercom(cdn)?\.(io|com)", r"fullstory\.com",
+]
+
+PROFILES: ty.Dict[str, RenderProfile] = {
+    "full": RenderProfile(name="full"),
+    "light": RenderProfile(
+        name="light",
+        blocked_resource_types=frozenset({"image", "media", "font"}),
+        blocked_url_patterns=TRACKER_PATTERNS,
+        splash_resource_timeout=10.,
+        splash_images=False,
+    ),
+}
+
+# the profile of the running crawl, set by RenderProfileMiddleware
+profile: RenderProfile = PROFILES["full"]
+
+
+def profile_from_settings(settings) -> RenderProfile:
+    name = settings.get("RENDER_PROFILE", "light")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown RENDER_PROFILE {name!r}, one of {sorted(PROFILES)}")
+    overrides = {}
+    if settings.get("RENDER_BLOCK_RESOURCE_TYPES") is not None:
+        overrides["blocked_resource_types"] = frozenset(settings.getlist("RENDER_BLOCK_RESOURCE_TYPES"))
+    if settings.get("RENDER_BLOCK_URL_PATTERNS") is not None:
+        overrides["blocked_url_patterns"] = settings.getlist("RENDER_BLOCK_URL_PATTERNS")
+    if settings.get("RENDER_SPLASH_FILTERS"):
+        overrides["splash_filters"] = settings.get("RENDER_SPLASH_FILTERS")
+    return PROFILES[name].copy(update=overrides)
+
+
+@dataclass
+class PageMetrics:
+    """Network use of a Playwright page, kept in the meta of the request that opened it"""
+    requests: int = 0
+    blocked: int = 0
+    failed: int = 0
+    bytes: int = 0
+
+
+# page -> its metrics, for abort_request which only gets to see the playwright request
+_page_metrics: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def abort_request(request) -> bool:
+    """PLAYWRIGHT_ABORT_REQUEST predicate of the active profile"""
+    if not profile.blocks(request.resource_type, request.url):
+        return False
+    try:
+        metrics = _page_metrics.get(request.frame.page)
+    except Exception:
+        # e.g. service worker requests have no frame
+        metrics = None
+    if metrics is not None:
+        metrics.blocked += 1
+    return True
+
+
+async def init_page(page, request):
+    """playwright_page_init_callback, counts the requests and bytes of the page"""
+    _page_metrics[page] = request.meta["render_metrics"] = PageMetrics()
+
+    # looked up on every event, pages reused for another request get new metrics
+    async def finished(pw_request):
+        if (metrics := _page_metrics.get(page)) is None:
+            return
+        metrics.requests += 1
+        try:
+            sizes = await pw_request.sizes()
+        except Exception:
+            return
+        metrics.bytes += sizes["responseBodySize"] + sizes["responseHeadersSize"]
+
+    def failed(pw_request):
+        if (metrics := _page_metrics.get(page)) is not None:
+            metrics.failed += 1
+
+    page.on("requestfinished", finished)
+    page.on("requestfailed", failed)
+
+
+def render_engine(request) -> ty.Optional[str]:
+    """splash or playwright, None for plain http requests"""
+    if "splash" in request.meta:
+        return "splash"
+    if request.meta.get("playwright"):
+        return "playwright"
+    return None
+
+
+# Splash execute scripts get the profile's args but have to apply them themselves,
+# call apply_profile(splash, args) first thing in main
+splash_profile_lua = """
+function apply_profile(splash, args)
+  if args.resource_timeout then
+    splash.resource_timeout = args.resource_timeout
+  end
+  if args.images ~= nil then
+    splash.images_enabled = args.images == 1
+  end
+end
+"""
+
+
+class RenderProfileMiddleware:
+    """
+    Downloader middleware: applies the render profile to Splash and Playwright requests
+    and records what rendering them cost. Goes before SplashMiddleware (725), so that
+    the Splash args it adds are sent and part of the render cache key.
+    """
+
+    def __init__(self, crawler):
+        global profile
+        profile = profile_from_settings(crawler.settings)
+        self.stats = crawler.stats
+        self.metrics = crawler.settings.getbool("RENDER_METRICS", True)
+        logger.info(f"Render profile: {profile}")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mw = cls(crawler)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def engine(self, request) -> ty.Optional[str]:
+        return render_engine(request)
+
+    def process_request(self, request, spider):
+        engine = self.engine(request)
+        if engine == "splash":
+            args = request.meta["splash"].setdefault("args", {})
+            for k, v in profile.splash_args().items():
+                args.setdefault(k, v)
+        elif engine == "playwright" and self.metrics:
+            request.meta.setdefault("playwright_page_init_callback", "scraper.render.init_page")
+            # a page from the pool (scraper/pagepool.py) is only initialised once
+            page = request.meta.get("playwright_page")
+            if page is not None and page in _page_metrics:
+                _page_metrics[page] = request.meta["render_metrics"] = PageMetrics()
+        if engine is not None:
+            request.meta["render_start"] = time.perf_counter()
+
+    def process_response(self, request, response, spider):
+        engine = self.engine(request)
+        start = request.meta.pop("render_start", None)
+        if engine is None or start is None or not self.metrics or "cached" in response.flags:
+            return response
+        prefix = f"render/{profile.name}/{engine}"
+        seconds = time.perf_counter() - start
+        self.stats.inc_value(f"{prefix}/pages")
+        self.stats.inc_value(f"{prefix}/seconds", seconds)
+        self.stats.max_value(f"{prefix}/max_seconds", seconds)
+        if engine == "splash":
+            # only the rendered document, Splash doesn't report its subresources
+            self.stats.inc_value(f"{prefix}/bytes", len(response.body))
+        elif (metrics := request.meta.get("render_metrics")) is not None:
+            self.stats.inc_value(f"{prefix}/bytes", metrics.bytes)
+            self.stats.inc_value(f"{prefix}/requests", metrics.requests)
+            self.stats.inc_value(f"{prefix}/blocked", metrics.blocked)
+            self.stats.inc_value(f"{prefix}/failed", metrics.failed)
+        return response
+
+    def spider_closed(self, spider):
+        for engine in ("splash", "playwright"):
+            prefix = f"render/{profile.name}/{engine}"
+            if not (pages := self.stats.get_value(f"{prefix}/pages")):
+                continue
+            seconds = self.stats.get_value(f"{prefix}/seconds", 0) / pages
+            kib = self.stats.get_value(f"{prefix}/bytes", 0) / pages / 1024
+            spider.logger.info(f"Render profile {profile.name}, {engine}: {pages} pages, {seconds:.2f}s and {kib:.0f}KiB per page")
+
+
+async def debug_screenshot(page, path: ty.Union[str, Path], settings, full_page: bool = False) -> bool:
+    """Screenshot `page` to `path` if RENDER_SCREENSHOTS is on and the sample allows, returns whether it did"""
+    if not settings.getbool("RENDER_SCREENSHOTS", False):
+        return False
+    if random.random() >= settings.getfloat("RENDER_SCREENSHOT_SAMPLE", 1.):
+        return False
+    await page.screenshot(path=str(path), full_page=full_page)
+    logger.debug(f"Screenshot captured at {path}")
+    return True
@@ -0,0 +1,119 @@
+"""
+replay.py
+
+Re-extract items from the rendered pages stored by RenderedPagePipeline, without any
+network access or rendering. Pages are decompressed and run through the spider's own
+`extract_item` in a process pool, and the extracted items are written through
+BatchedSQLModelItemPipeline like those of a live crawl, e.g. after an XPath change:
+
+    python -m scraper.replay icml_2022_crawler --workers 8
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import time
+import typing as ty
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy import Spider
+from scrapy.crawler import Crawler
+from scrapy.http import HtmlResponse
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import get_project_settings
+from sqlmodel import Session, select
+
+from scraper.db import get_engine, RenderedPage
+from scraper.pipelines import BatchedSQLModelItemPipeline
+
+
+logger = logging.getLogger(__name__)
+
+# spider instance of each worker process, set up once by init_worker
+_spider: ty.Optional[Spider] = None
+
+
+def load_spider_class(name: str) -> ty.Type[Spider]:
+    return SpiderLoader.from_settings(get_project_settings()).load(name)
+
+
+def init_worker(spider_name: str, spider_kwargs: ty.Dict[str, str]):
+    global _spider
+    _spider = load_spider_class(spider_name)(**spider_kwargs)
+    # replayed pages aren't crawl progress, and the worker has no crawler to record it with
+    _spider.scraped = lambda item, url, kind=None: item
+
+
+def extract(page: ty.Tuple[str, bytes]) -> list:
+    """Run one stored page through the worker's spider, returns the extracted items"""
+    url, body = page
+    response = HtmlResponse(url=url, body=zlib.decompress(body))
+    try:
+        items = list(_spider.extract_item(response) or [])
+    except Exception as err:
+        logger.error(f"Failed to extract {url}: {err!r}")
+        return []
+    for item in items:
+        # the page is already stored
+        item.pop("html", None)
+    return items
+
+
+def iter_pages(spider_name: str, chunk_size: int = 500) -> ty.Iterator[ty.Tuple[str, bytes]]:
+    with Session(get_engine()) as session:
+        q = select(RenderedPage.url, RenderedPage.body).where(RenderedPage.spider == spider_name)
+        yield from session.exec(q.execution_options(yield_per=chunk_size))
+
+
+def replay(spider_name: str, spider_kwargs: ty.Optional[ty.Dict[str, str]] = None, workers: ty.Optional[int] = None,
+           chunksize: int = 32) -> ty.Dict[str, ty.Any]:
+    """Re-extract every stored page of `spider_name` and persist the items, returns the crawl stats"""
+    spider_kwargs = spider_kwargs or {}
+    workers = workers or os.cpu_count() or 1
+    # pages handed to the pool at a time, so that memory doesn't grow with the stored pages
+    window = workers * chunksize * 4
+    spidercls = load_spider_class(spider_name)
+    settings = get_project_settings()
+    # no reactor here to hand the writes to threads from, the process pool is what's parallel
+    settings.set("SQLMODEL_WRITER_THREADS", 0)
+    crawler = Crawler(spidercls, settings)
+    spider = spidercls.from_crawler(crawler, **spider_kwargs)
+    pipeline = BatchedSQLModelItemPipeline.from_crawler(crawler)
+    pipeline.open_spider(spider)
+    start = time.perf_counter()
+    n_pages = 0
+    try:
+        pages = iter_pages(spider_name)
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(spider_name, spider_kwargs)) as pool:
+            while batch := list(itertools.islice(pages, window)):
+                for items in pool.map(extract, batch, chunksize=chunksize):
+                    n_pages += 1
+                    crawler.stats.inc_value("replay/pages")
+                    for item in items:
+                        crawler.stats.inc_value("replay/items")
+                        pipeline.process_item(item, spider)
+    finally:
+        # no reactor running here: close_spider's Deferred would never fire, so the
+        # last partial batch is flushed by running close() to completion instead
+        asyncio.get_event_loop_policy().get_event_loop().run_until_complete(pipeline.close())
+    elapsed = time.perf_counter() - start
+    crawler.stats.set_value("replay/elapsed", elapsed)
+    logger.info(f"Replayed {n_pages} pages in {elapsed:.1f}s ({n_pages / elapsed if elapsed else 0:.1f} pages/s)")
+    return crawler.stats.get_stats()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spider", help="name of the spider whose pages to replay")
+    parser.add_argument("-a", dest="spider_args", action="append", default=[], metavar="NAME=VALUE",
+                        help="spider argument, as for scrapy crawl")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes (default: one per cpu)")
+    parser.add_argument("--chunksize", type=int, default=32, help="pages sent to a worker at a time")
+    args = parser.parse_args()
+
+    spider_kwargs = dict(a.split("=", 1) for a in args.spider_args)
+    stats = replay(args.spider, spider_kwargs, workers=args.workers, chunksize=args.chunksize)
+    logger.info(f"Replay stats: {stats}")
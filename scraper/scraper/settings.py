@@ -15,7 +15,19 @@ class Settings(BaseSettings):
     async_database_url: AnyUrl
     database_test_url: AnyUrl
     async_database_test_url: AnyUrl
-    echo_sql: bool = True
+    # logs every statement, expensive under load
+    echo_sql: bool = False
+    # connection pools (per engine): size them against CONCURRENT_REQUESTS and the
+    # number of async writers, see the db_pool/* stats dumped when a spider closes
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.
+    db_pool_pre_ping: bool = True
+    db_pool_recycle: int = 1800
+    # asyncpg only: server-side prepared statement cache per connection, and the
+    # SQLAlchemy adapter's cache of prepared statements reused across executions
+    db_statement_cache_size: int = 100
+    db_prepared_statement_cache_size: int = 100
 
 
 def get_settings() -> Settings:
@@ -68,6 +80,7 @@ DOWNLOAD_DELAY = .25
 #}
 SPIDER_MIDDLEWARES = {
     #'scrapy_splash.SplashDeduplicateArgsMiddleware': 100,
+    'scraper.metrics.StageTimingMiddleware': 950,
 }
 
 # Playwright integration
@@ -79,6 +92,15 @@ TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 PLAYWRIGHT_MAX_CONTEXTS = 8
 PLAYWRIGHT_MAX_PAGES_PER_CONTEXT = 4
 PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 0# no timeout, or 10 * 1000  # 10 seconds
+# render profile (see scraper/render.py): 'light' skips images, media, fonts and trackers,
+# 'full' loads everything
+RENDER_PROFILE = 'light'
+PLAYWRIGHT_ABORT_REQUEST = 'scraper.render.abort_request'
+# render time and bandwidth per page under render/<profile>/* in the stats
+RENDER_METRICS = True
+# debugging screenshots, taken for this fraction of the pages when enabled
+RENDER_SCREENSHOTS = False
+RENDER_SCREENSHOT_SAMPLE = 0.05
 #PLAYWRIGHT_LAUNCH_OPTIONS = dict(headless=False)
 #PLAYWRIGHT_BROWSER_TYPE = "firefox"
 
@@ -90,6 +112,8 @@ PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 0# no timeout, or 10 * 1000  # 10 second
 DOWNLOADER_MIDDLEWARES = {
     #'scrapy_splash.SplashCookiesMiddleware': 723,
     #'scrapy_splash.SplashMiddleware': 725,
+    'scraper.crawlstate.CrawlStateMiddleware': 50,
+    'scraper.render.RenderProfileMiddleware': 700,
     'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810,
 }
 
@@ -98,12 +122,39 @@ DOWNLOADER_MIDDLEWARES = {
 #EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 #}
+EXTENSIONS = {
+    'scraper.extensions.ReactorStallMonitor': 500,
+    'scraper.metrics.StageMetrics': 510,
+}
+# reactor/stall_* stats: timer fired more than REACTOR_STALL_THRESHOLD seconds late
+REACTOR_STALL_INTERVAL = 0.1
+REACTOR_STALL_THRESHOLD = 0.05
+# per-stage latency histograms, queue depths and item rate (see scraper/metrics.py), served
+# in the Prometheus format on the first free port of STAGE_METRICS_PORT ([] to not serve)
+STAGE_METRICS_ENABLED = True
+STAGE_METRICS_HOST = '127.0.0.1'
+STAGE_METRICS_PORT = [9410, 9430]
+STAGE_METRICS_INTERVAL = 5.0
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-   'scraper.pipelines.SQLModelItemPipeline': 300,
+   'scraper.pipelines.RenderedPagePipeline': 200,
+   'scraper.pipelines.BatchedSQLModelItemPipeline': 300,
 }
+# keep the compressed html of every item for re-extraction with scraper.replay
+STORE_RENDERED_PAGES = True
+# number of items buffered by BatchedSQLModelItemPipeline per INSERT transaction
+SQLMODEL_BATCH_SIZE = 200
+# max author/keyword natural keys kept in the pipelines' in-process identity map
+SQLMODEL_IDENTITY_CACHE_SIZE = 50_000
+# threads the sync pipelines write on, off the reactor thread. 1 keeps items in order,
+# 0 writes inline on the reactor thread
+SQLMODEL_WRITER_THREADS = 1
+# AsyncSQLModelItemPipeline: concurrent writer tasks and the item queue feeding them,
+# the engine is paused while the queue is full
+SQLMODEL_ASYNC_WRITERS = 4
+SQLMODEL_WRITE_QUEUE_SIZE = 500
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -127,4 +178,19 @@ ITEM_PIPELINES = {
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
 
 DUPEFILTER_CLASS = 'scrapy_splash.SplashAwareDupeFilter'
-HTTPCACHE_STORAGE = 'scrapy_splash.SplashAwareFSCacheStorage'
\ No newline at end of file
+
+# Render cache: plain, Splash and Playwright responses in one compressed SQLite file per
+# spider under .scrapy/httpcache, see scraper/httpcache.py. Re-run the parsers against it
+# without network access with `-s RENDERCACHE_OFFLINE=1`
+HTTPCACHE_ENABLED = True
+HTTPCACHE_DIR = 'httpcache'
+HTTPCACHE_EXPIRATION_SECS = 7 * 24 * 3600
+HTTPCACHE_STORAGE = 'scraper.httpcache.SQLiteRenderCacheStorage'
+HTTPCACHE_POLICY = 'scraper.httpcache.RenderCachePolicy'
+RENDERCACHE_MAX_BYTES = 2 * 1024 ** 3
+RENDERCACHE_COMPRESSION_LEVEL = 6
+RENDERCACHE_OFFLINE = False
+
+# per-url crawl progress, see scraper/crawlstate.py
+CRAWLSTATE_DIR = '.crawlstate'
+CRAWLSTATE_MAX_RETRIES = 3
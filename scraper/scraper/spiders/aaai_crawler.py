@@ -2,15 +2,17 @@
 aaai_crawler.py
 """
 import asyncio
+import contextlib
 import inspect
 import json
+import logging
 import os
 import re
+import time
 import typing as ty
 from pathlib import Path
 from typing import Callable, TypeVar, Any
 from functools import wraps
-from urllib.parse import urljoin
 
 import playwright._impl
 import pydantic
@@ -21,15 +23,63 @@ from scrapy.loader import ItemLoader
 from scrapy.spiders import CrawlSpider, Rule
 from scrapy.http import Response
 from scrapy import FormRequest
+from scrapy.exceptions import IgnoreRequest
 from scrapy.utils.log import configure_logging
-from scrapy.selector import Selector
 
 from scraper.items import ConferenceItem, AAAILoaderItem
-from scraper import models
+from scraper import models, pagepool
+from scraper.auth import StorageStateCache
+from scraper.crawlstate import ResumableSpider
+from scraper.harvest import harvest_links
+from scraper.render import debug_screenshot
+from scraper.underline import index_lectures, is_complete, lecture_id
+from scraper.waits import site_key, timeouts, wait_network_idle
 
 
 configure_logging(settings = None, install_root_handler = True)
 
+# every field of a poster page in one round-trip: opens the abstract tab if its panel
+# is still empty and waits (at most `timeout` ms) for its text, the time it took is
+# reported back as abstract_ms (null if it timed out or wasn't needed)
+EXTRACT_POSTER_JS = """
+async (timeout) => {
+  const text = (el) => el ? el.innerText.trim() : null;
+  const title = [...document.querySelectorAll("h1")].pop();
+  let authors = title ? title.nextElementSibling : null;
+  while (authors && authors.tagName !== "DIV") authors = authors.nextElementSibling;
+  const download = (kind) => {
+    const a = [...document.querySelectorAll(`a[download='${kind}']`)].find(a => a.textContent.includes("Download"));
+    return a ? a.href : null;
+  };
+  const tab = [...document.querySelectorAll("button")].find(b => b.textContent.trim() === "Abstract");
+  const panel = () => (tab && document.getElementById(tab.getAttribute("aria-controls")))
+    || document.querySelector("div[role='tabpanel']:not([hidden])");
+  const paragraphs = () => {
+    const p = panel();
+    return p ? [...p.querySelectorAll("p")].map(e => e.textContent.trim()).filter(t => t) : [];
+  };
+  let abstract = paragraphs();
+  let abstract_ms = null;
+  if (!abstract.length && tab) {
+    tab.click();
+    const start = performance.now();
+    while (!(abstract = paragraphs()).length && performance.now() - start < timeout) {
+      await new Promise(resolve => setTimeout(resolve, 50));
+    }
+    abstract_ms = abstract.length ? performance.now() - start : null;
+  }
+  return {
+    title: text(title),
+    authors: text(authors),
+    abstract: abstract.join(" "),
+    abstract_tab: !!tab,
+    abstract_ms: abstract_ms,
+    paper_url: download("paper"),
+    slides_url: download("slides"),
+  };
+}
+"""
+
 T = TypeVar("T", bound=Callable[..., Any])
 
 class AAAISettings(pydantic.BaseModel):
@@ -39,51 +89,11 @@ class AAAISettings(pydantic.BaseModel):
     underline_email: pydantic.EmailStr = pydantic.Field(default=os.getenv("UNDERLINE_EMAIL"), env="UNDERLINE_EMAIL")
     underline_password: str = pydantic.Field(default=os.getenv("UNDERLINE_PASSWORD"))
     remember_me: bool = pydantic.Field(default=False, env="UNDERLINE_REMEMBER_ME")
+    # encrypts the cached login, derived from the password if not set
+    storage_state_key: ty.Optional[str] = pydantic.Field(default=os.getenv("STORAGE_STATE_KEY"))
 
 
-async def wait_idle_then_sleep(page, sleep: float = 3):
-    """"""
-    await page.wait_for_load_state("networkidle")
-    await asyncio.sleep(sleep)
-
-
-async def click_with_retry(element, logger, retries=3):
-    for i in range(retries):
-        try:
-            logger.debug(f"Click attempt #{i + 1}")
-            await element.click()
-            logger.debug(f"Click succeeded on attempt #{i + 1}")
-            return
-        except Exception as e:
-            logger.exception(e)
-            logger.warning(f"Click failed on attempt #{i + 1}: {str(e)}")
-            await asyncio.sleep(1)
-
-    logger.error("Failed to click the element after retries")
-    raise Exception("Failed to click the element after retries")
-
-
-# --
-import pandas as pd
-
-def in_csv(url, csv="./scraped.csv"):
-    try:
-        df = pd.read_csv(csv, index_col=0)
-        urls = df.url
-        return (urls == url).any()
-    except FileNotFoundError:
-        return False
-
-def write_to_csv(url, csv="./scraped.csv"):
-    if Path(csv).exists():
-        df = pd.read_csv(csv, index_col=0)
-        urls = pd.concat([df.url, pd.Series([url])])
-        urls.name = "url"
-    else:
-        urls = pd.Series([url], name="url")
-    urls.to_csv(csv)
-
-async def async_iterator_with_timeout(async_iter, timeout):
+async def async_iterator_with_timeout(async_iter, timeout, logger: logging.Logger = logging.getLogger(__name__)):
     async def get_next_item(iterator):
         try:
             return await iterator.__anext__()
@@ -97,20 +107,56 @@ async def async_iterator_with_timeout(async_iter, timeout):
                 break
             yield next_item
         except asyncio.TimeoutError:
-            print("Timeout reached")
+            logger.warning(f"Timed out after {timeout}s waiting for the next item")
             break
 
 
-class AAAI2023CrawlerSpider(scrapy.Spider):#scrapy.Spider):
+class AAAI2023CrawlerSpider(ResumableSpider, scrapy.Spider):
+    """
+    Logs in once, collects every poster (and optionally session) url from the listings
+    in a single page, then fans the poster pages out as independent requests over
+    AAAI_CONTEXTS browser contexts, all seeded with the storage state of the login.
+
+    The storage state is registered with the page pool by context name (see
+    register_contexts) and never put in request meta, so the session cookies stay out of
+    the JOBDIR.
+
+    Throughput is bounded by the politeness budget below rather than by a single tab,
+    override with e.g. `-s AAAI_CONTEXTS=2 -s CONCURRENT_REQUESTS_PER_DOMAIN=2`.
+    """
     name: str = 'aaai_2023_crawler'
     conference: str = "AAAI"
     custom_settings = {
         'LOG_LEVEL': 'INFO', # can also scrapy crawl aaai_2023_crawler --loglevel=DEBUG
         'DOWNLOADER_MIDDLEWARES': {
+            'scraper.crawlstate.CrawlStateMiddleware': 50,
+            'scraper.pagepool.PagePoolMiddleware': 650,
+            'scraper.render.RenderProfileMiddleware': 700,
             'scraper.middlewares.DebugHeaderMiddleware': 1000,
         },
-        'DOWNLOAD_DELAY': 5,
-        'CONCURRENT_REQUESTS_PER_DOMAIN':1, 
+        # politeness budget: at most this many poster pages open at once, one request
+        # started per DOWNLOAD_DELAY seconds, slowed down further by autothrottle when
+        # the site's latency goes up
+        'AAAI_CONTEXTS': 4,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'DOWNLOAD_DELAY': 1,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 1,
+        'AUTOTHROTTLE_MAX_DELAY': 30,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 2.,
+        'PLAYWRIGHT_MAX_PAGES_PER_CONTEXT': 1,
+        # pages are reused across requests of their context (scraper/pagepool.py) and
+        # replaced after this many seconds or navigations
+        'PAGEPOOL_MAX_AGE': 600,
+        'PAGEPOOL_MAX_NAVIGATIONS': 50,
+        'PAGEPOOL_LEASE_TIMEOUT': 300,
+        # logged in session reused across restarts, see scraper/auth.py
+        'AAAI_STORAGE_STATE_PATH': '.auth/underline-state.bin',
+        'AAAI_STORAGE_STATE_MAX_AGE': 12 * 3600,
+        # build items from the JSON the pages fetch (see scraper/underline.py), clicking
+        # through the poster tabs only for posters missing from it
+        'AAAI_API_CAPTURE': True,
+        'AAAI_API_PATTERN': r"/api/",
         'ITEM_PIPELINES' : {
         'scraper.pipelines.AsyncSQLModelItemPipeline': 300,
         }
@@ -121,62 +167,321 @@ class AAAI2023CrawlerSpider(scrapy.Spider):#scrapy.Spider):
         "https://underline.io/log-in?redirectUrl=/events/380/reception"
     ]
     posters_url: str = "https://underline.io/events/380/posters"
+    sessions_url: str = "https://underline.io/events/380/sessions"
+    # listings to collect pages from, `-a listings=posters,sessions` for both
+    listings: str = "posters"
+    # links harvested from the listings while scrolling them, see scraper/harvest.py
+    events_selector: str = "a[class*='chakra-button']"
+    poster_link_selector: str = "main a"
+    session_link_selector: str = "main > div > div:nth-of-type(2) a:not([target='blank']):not([target='_blank'])"
+    # the sessions list only scrolls with the End key once it has focus
+    sessions_focus_selector: str = "xpath=//main/div/div[2]/div[2]"
     # spoof a regular browser
     #user_agent = ('Mozilla/5.0 (X11; Linux x86_64; rv:74.0) '
     #              'Gecko/20100101 Firefox/74.0')
     # credentials from env vars
     aaai_settings: AAAISettings = AAAISettings()
+    # cookies and local storage of the logged in session, from the cache or after_login
+    storage_state: ty.Optional[ty.Dict[str, ty.Any]] = None
+    # bumped on every login so that requests after a re-login get fresh contexts
+    login_generation: int = 0
+    logging_in: bool = False
+    relogins: int = 0
+    # (url, kind) of pages to retry once logged in again
+    pending: ty.List[ty.Tuple[str, str]] = []
+    # listings whose pages are queued in this run, not collected again after a re-login
+    queued_listings: ty.Set[str] = set()
+    # page -> captured API responses not read yet
+    api_responses: ty.Dict[ty.Any, ty.List[ty.Any]] = {}
 
     async def errback(self, failure):
+        if failure.check(IgnoreRequest):
+            # dropped by CrawlStateMiddleware, already scraped
+            return
         self.logger.error(f"Error: {failure}")
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        request = failure.request
+        page = request.meta.pop("playwright_page", None)
+        if page is not None:
+            self.api_responses.pop(page, None)
+            await pagepool.pool.discard(page)
+        kind = request.meta.get("kind")
+        if kind is not None and (retry := self.retry(request.url, kind, repr(failure.value))) is not None:
+            yield retry
+
+    def retry(self, url: str, kind: str, error: str) -> ty.Optional[scrapy.Request]:
+        """Record a failed attempt at a page, and a new request for it unless it failed too often"""
+        failures = self.crawl_state.mark_failed(url, error=error, kind=kind)
+        if failures >= self.crawl_state.max_retries:
+            return None
+        self.crawler.stats.inc_value(f"crawlstate/{kind}_retries")
+        return self.poster_request(url, failures, kind=kind)
 
     def start_requests(self):
         """
-        Log in to receive session cookies. Then proceed with scraping
+        Start from the cached logged in session if there is one, else log in to receive
+        session cookies. Then proceed with scraping
+        """
+        self.auth_cache = StorageStateCache(
+            self.settings.get("AAAI_STORAGE_STATE_PATH"),
+            key=self.aaai_settings.storage_state_key,
+            password=self.aaai_settings.underline_password,
+            max_age=self.settings.getfloat("AAAI_STORAGE_STATE_MAX_AGE"),
+        )
+        # carried over from the previous run (JOBDIR) so that its pending requests
+        # aren't mistaken for requests of an older session
+        self.login_generation = getattr(self, "state", {}).get("login_generation", 0)
+        self.pending = []
+        self.queued_listings = set()
+        self.api_responses = {}
+        self.storage_state = self.auth_cache.load()
+        if self.storage_state is not None:
+            self.crawler.stats.inc_value("auth/cached_session")
+            self.register_contexts()
+            yield from self.listing_requests()
+        else:
+            yield self.login_request()
+
+    def login_request(self) -> scrapy.Request:
+        url = self.start_urls[0]
+        self.logging_in = True
+        self.logger.info(f"Start scraping URL: {url}")
+        self.logger.info("Login")
+        return scrapy.Request(
+            url,
+            callback=self.after_login,
+            errback=self.errback,
+            dont_filter=True,
+            meta=dict(
+                playwright=True,
+                playwright_include_page=True, # keep page object to work with
+                playwright_context=f"login-{self.login_generation}",
+                # the form is filled in by after_login, the credentials mustn't be in the
+                # request (the JOBDIR pickles pending requests)
+                playwright_page_methods = [
+                    PageMethod("wait_for_selector", "button[type=submit]"),#productListing")
+                ],
+            ),
+        )
+
+    async def fill_login_form(self, page):
+        await page.fill("input#email", self.aaai_settings.underline_email)
+        await page.fill("input#password", self.aaai_settings.underline_password)
+        await page.click("label[for=rememberMe]")
+        await page.click("button[type=submit]")
+        await page.wait_for_load_state("networkidle")
+
+    def logged_out(self, page) -> bool:
+        """Validity probe: pages of an expired session redirect to the login form"""
+        return "log-in" in page.url
+
+    def relogin(self, response) -> ty.Iterator[scrapy.Request]:
         """
-        for url in self.start_urls:
-            # login
-            self.logger.info(f"Start scraping URL: {url}")
-            self.logger.info("Login")
+        Log in again if the page's session is the current one, and retry poster pages
+        with the new session (listings not queued yet are requested again by after_login)
+        """
+        if response.meta["login_generation"] == self.login_generation and not self.logging_in:
+            self.logger.warning("Session expired, logging in again")
+            self.crawler.stats.inc_value("auth/expired_session")
+            self.auth_cache.invalidate()
+            self.relogins += 1
+            yield self.login_request()
+        kind = response.meta.get("kind")
+        if kind is None:
+            return
+        if self.logging_in:
+            self.pending.append((response.url, kind))
+        else:
+            yield self.poster_request(response.url, len(self.pending), kind=kind)
+
+    def context_names(self) -> ty.List[str]:
+        """Contexts of the current session's pages, see playwright_meta"""
+        contexts = ["listing"] + [f"poster-{i}" for i in range(self.settings.getint("AAAI_CONTEXTS", 4))]
+        return [f"{context}-{self.login_generation}" for context in contexts]
+
+    def register_contexts(self):
+        """Have the contexts of the current session created logged in, from the page pool"""
+        pagepool.pool.context_kwargs.clear()
+        for name in self.context_names():
+            pagepool.pool.context_kwargs[name] = dict(storage_state=self.storage_state)
+
+    def playwright_meta(self, context: str, **kwargs) -> ty.Dict[str, ty.Any]:
+        """Request meta for a page in `context`, created logged in if it doesn't exist yet"""
+        if self.settings.getbool("AAAI_API_CAPTURE"):
+            kwargs.setdefault("playwright_page_event_handlers", {"response": "capture_api_response"})
+        return dict(
+            playwright=True,
+            playwright_include_page=True,
+            playwright_context=f"{context}-{self.login_generation}",
+            login_generation=self.login_generation,
+            **kwargs
+        )
+
+    async def capture_api_response(self, response):
+        """Page event handler, keeps the JSON API responses of the page to read them later"""
+        if response.request.resource_type not in ("xhr", "fetch"):
+            return
+        if "json" not in response.headers.get("content-type", ""):
+            return
+        if not re.search(self.settings.get("AAAI_API_PATTERN"), response.url):
+            return
+        self.api_responses.setdefault(response.frame.page, []).append(response)
+
+    async def api_lectures(self, page, lectures: ty.Dict[str, ty.Dict[str, ty.Any]]) -> ty.Dict[str, ty.Dict[str, ty.Any]]:
+        """Merge the lectures of the responses `page` captured since the last call into `lectures`"""
+        responses, self.api_responses[page] = self.api_responses.get(page, []), []
+        payloads = []
+        for response in responses:
+            try:
+                payloads.append(await response.json())
+            except Exception as e:
+                self.crawler.stats.inc_value("aaai_api/unreadable")
+                self.logger.debug(f"Could not read API response {response.url}: {e}")
+        self.crawler.stats.inc_value("aaai_api/payloads", len(payloads))
+        for id_, fields in index_lectures(payloads, page.url).items():
+            lectures.setdefault(id_, {}).update(fields)
+        return lectures
+
+    def api_item(self, url: str, fields: ty.Dict[str, ty.Any]) -> AAAILoaderItem:
+        loader = ItemLoader(item=AAAILoaderItem())
+        loader.add_value("url", url)
+        loader.add_value("conference", self.conference)
+        loader.add_value("year", self.year)
+        for field, value in fields.items():
+            loader.add_value(field, value)
+        return loader.load_item()
+
+    async def listing_item(self, page, url: str, lectures: ty.Dict[str, ty.Dict[str, ty.Any]]) -> ty.Optional[AAAILoaderItem]:
+        """The item of a poster linked from a listing, if the listing's API data has all of it"""
+        if not self.settings.getbool("AAAI_API_CAPTURE"):
+            return None
+        await self.api_lectures(page, lectures)
+        fields = lectures.get(lecture_id(url))
+        if fields is None or not is_complete(fields):
+            return None
+        self.crawler.stats.inc_value("aaai_api/listing_items")
+        return self.api_item(url, fields)
+
+    async def detail_item(self, page, url: str) -> ty.Optional[AAAILoaderItem]:
+        """The item of a poster page from its API data, None if it's incomplete"""
+        lectures = await self.api_lectures(page, {})
+        if not is_complete(lectures.get(lecture_id(url), {})):
+            # details may still be in flight
+            await wait_network_idle(page, condition="api")
+            await self.api_lectures(page, lectures)
+        fields = lectures.get(lecture_id(url), {})
+        if not is_complete(fields):
+            self.crawler.stats.inc_value("aaai_api/dom_fallback")
+            return None
+        self.crawler.stats.inc_value("aaai_api/detail_items")
+        return self.api_item(url, fields)
+
+    @contextlib.asynccontextmanager
+    async def leased_page(self, response):
+        """The response's page, returned to the pool afterwards (closed on error) without its captured API responses"""
+        page = response.meta["playwright_page"]
+        try:
+            async with pagepool.leased_page(response):
+                yield page
+        finally:
+            self.api_responses.pop(page, None)
+
+    def poster_request(self, url: str, n: int, kind: str = "poster") -> scrapy.Request:
+        n_contexts = self.settings.getint("AAAI_CONTEXTS", 4)
+        return scrapy.Request(
+            url,
+            callback=self.parse_poster_page,
+            errback=self.errback,
+            # the crawl state decides what is requested again (CrawlStateMiddleware), the
+            # JOBDIR's seen requests include those of pages whose items a crash lost
+            dont_filter=True,
+            meta=self.playwright_meta(f"poster-{n % n_contexts}", kind=kind),
+        )
+
+    async def after_login(self, response):
+        page = response.meta["playwright_page"]
+        try:
+            await self.fill_login_form(page)
+        except Exception:
+            await pagepool.pool.discard(page)
+            raise
+        # do stuff like populate item from response html + selectors...
+        await debug_screenshot(page, "after_login.png", self.settings, full_page=True)
+        self.storage_state = await page.context.storage_state()
+        await pagepool.pool.discard(page)
+        await page.context.close()
+        self.auth_cache.save(self.storage_state)
+        self.crawler.stats.inc_value("auth/logins")
+        self.login_generation += 1
+        if hasattr(self, "state"):
+            self.state["login_generation"] = self.login_generation
+        self.register_contexts()
+        self.logging_in = False
+        # contexts of the previous session, closed as soon as their pages are returned
+        await pagepool.pool.retire(lambda context: not context.endswith(f"-{self.login_generation}"))
+        for request in self.listing_requests():
+            yield request
+        # pages that found themselves logged out while logging in
+        pending, self.pending = self.pending, []
+        for i, (url, kind) in enumerate(pending):
+            yield self.poster_request(url, i, kind=kind)
+
+    def saved_listing_requests(self, url: str, kind: str = "poster") -> ty.Iterator[scrapy.Request]:
+        """Requests for the pages of a listing saved by an earlier visit which aren't done yet"""
+        n = 0
+        for page_url in self.crawl_state.listing(url) or []:
+            if not self.crawl_state.is_done(page_url):
+                yield self.poster_request(page_url, n, kind=kind)
+                n += 1
+        self.queued_listings.add(url)
+        if n:
+            self.logger.info(f"Queued {n} pages of the saved listing {url}")
+
+    def listing_requests(self) -> ty.Iterator[scrapy.Request]:
+        """
+        Pages of the listings saved by an earlier run are queued again straight from the
+        crawl state (the frontier of a crashed run misses those that were in flight), and
+        only listings which weren't loaded completely yet are opened
+        """
+        listings = self.listings.split(",")
+        open_posters = False
+        if "posters" in listings:
+            events = self.crawl_state.listing(self.posters_url)
+            for event_url, _ in events or []:
+                if event_url not in self.queued_listings and self.crawl_state.listing(event_url) is not None:
+                    yield from self.saved_listing_requests(event_url)
+            open_posters = events is None or any(event_url not in self.queued_listings for event_url, _ in events)
+        if open_posters:
+            self.logger.info("Open posters page")
             yield scrapy.Request(
-                url,
-                callback=self.open_poster_page,
-                meta=dict(
-                    playwright=True,
-                    playwright_include_page=True, # keep page object to work with
-                    playwright_page_methods = [
-                        PageMethod("wait_for_selector", "button[type=submit]"),#productListing")
-                        PageMethod("fill", "input#email", self.aaai_settings.underline_email),
-                        PageMethod("fill", "input#password", self.aaai_settings.underline_password),
-                        PageMethod("click", "label[for=rememberMe]"),
-                        PageMethod("screenshot", path="login.png"),
-                        PageMethod("click", "button[type=submit]"),
-                        PageMethod("wait_for_load_state", "networkidle"),
-                    ],
-                    errback=self.errback,
-                )
+                self.posters_url,
+                callback=self.collect_posters,
+                errback=self.errback,
+                dont_filter=True,
+                meta=self.playwright_meta(
+                    "listing",
+                    playwright_page_methods=[PageMethod("wait_for_load_state", "networkidle")],
+                    screenshot_name="open_poster_page",
+                    # scrolls through every event, no time limit on its page
+                    pagepool_lease_timeout=None,
+                ),
+            )
+        if "sessions" in listings and self.sessions_url not in self.queued_listings:
+            if self.crawl_state.listing(self.sessions_url) is not None:
+                yield from self.saved_listing_requests(self.sessions_url, kind="session")
+                return
+            self.logger.info("Open sessions page")
+            yield scrapy.Request(
+                self.sessions_url,
+                callback=self.collect_sessions,
+                errback=self.errback,
+                dont_filter=True,
+                meta=self.playwright_meta(
+                    "listing",
+                    playwright_page_methods=[PageMethod("wait_for_load_state", "networkidle")],
+                    screenshot_name="open_session_page",
+                    pagepool_lease_timeout=None,
+                ),
             )
-            # yield scrapy.Request(
-            #     url,
-            #     callback=self.open_session_page,
-            #     meta=dict(
-            #         playwright=True,
-            #         playwright_include_page=True, # keep page object to work with
-            #         playwright_page_methods = [
-            #             PageMethod("wait_for_selector", "button[type=submit]"),#productListing")
-            #             PageMethod("fill", "input#email", self.aaai_settings.underline_email),
-            #             PageMethod("fill", "input#password", self.aaai_settings.underline_password),
-            #             PageMethod("click", "label[for=rememberMe]"),
-            #             PageMethod("screenshot", path="login.png"),
-            #             PageMethod("click", "button[type=submit]"),
-            #             PageMethod("wait_for_load_state", "networkidle"),
-            #         ],
-            #         errback=self.errback,
-            #     )
-            # )
-
 
     async def capture_screenshot(self, response):
         page = response.meta["playwright_page"]
@@ -193,9 +498,8 @@ class AAAI2023CrawlerSpider(scrapy.Spider):#scrapy.Spider):
                 stem = screenshot_name.stem
             screenshot_name = screenshot_name.parent / (stem + f"-{ix}.png")
         # do stuff like populate item from response html + selectors...
-        screenshot = await page.screenshot(path=screenshot_name, full_page=True)
-        self.logger.info(f"screenshot captured at: {screenshot_name}")
-        await page.close()
+        await debug_screenshot(page, screenshot_name, self.settings, full_page=True)
+        await pagepool.pool.release(page)
 
     def get_screenshot_name(self, response):
         screenshot_name = response.meta.get("screenshot_name", "untitled_screenshot.png")
@@ -212,376 +516,143 @@ class AAAI2023CrawlerSpider(scrapy.Spider):#scrapy.Spider):
             screenshot_name = screenshot_name.parent / (stem + f"-{ix}.png")
         return screenshot_name
 
-    async def open_poster_page(self, response):
-        page = response.meta["playwright_page"]
-        # do stuff like populate item from response html + selectors...
-        screenshot = await page.screenshot(path="./after_login.png", full_page=True)
-        self.logger.info("screenshot captured")
-        await page.close()
-        # open the page to all posters
-        self.logger.info("Open posters page")
-        yield scrapy.Request(
-            response.url,
-            callback=self.open_events,#self.open_events,
-            meta=dict(
-                playwright=True,
-                playwright_include_page=True, # keep page object to work with
-                playwright_page_methods = [
-                    PageMethod("wait_for_selector", "a[href='/events/380/posters']"),#productListing")
-                    PageMethod("click", "a[href='/events/380/posters']"),
-                    PageMethod("wait_for_load_state", "networkidle"),
-                ],
-                errback=self.errback,
-                screenshot_name=inspect.currentframe().f_code.co_name
-            )
-        )
-
-    async def open_session_page(self, response):
-        page = response.meta["playwright_page"]
-        # do stuff like populate item from response html + selectors...
-        await page.close()
-        # open the page to all posters
-        self.logger.info("Open session page")
-        yield scrapy.Request(
-            response.url,
-            callback=self.open_sessions,#self.open_events,
-            meta=dict(
-                playwright=True,
-                playwright_include_page=True, # keep page object to work with
-                playwright_page_methods = [
-                    PageMethod("wait_for_selector", "a[href='/events/380/sessions']"),#productListing")
-                    PageMethod("click", "a[href='/events/380/sessions']"),
-                    PageMethod("wait_for_load_state", "networkidle"),
-                ],
-                errback=self.errback,
-                screenshot_name=inspect.currentframe().f_code.co_name
-            )
-        )
-
-    async def scroll_to_bottom(self, page, item_xpath, sleep=2.5, min_items: int = 0):
-        await asyncio.sleep(sleep)
-        ix = 1
-        while True:
-            n_poster_elements = len(await asyncio.wait_for(page.query_selector_all(item_xpath), timeout=30.))
-            await page.keyboard.press("End")
-            self.logger.info(f"scrolling key press: {ix} on {page.url}, n elements {n_poster_elements}")
-            await asyncio.sleep(sleep)
-            n_poster_elements_after = len(await asyncio.wait_for(page.query_selector_all(item_xpath), timeout=30.))
-            ix += 1
-            if n_poster_elements_after == n_poster_elements and n_poster_elements_after > min_items:
-                self.logger.info(f"stop scroll, items haven't changed and minimum of {min_items} items exceeded")
-                await page.wait_for_load_state("networkidle")
-                break
-
-    async def open_sessions(self, response, n_sessions_expected=1154, grace_factor=0.97):
+    async def collect_sessions(self, response, n_sessions_expected=1154, grace_factor=0.97):
         """
         1154 `a` elements on https://underline.io/events/380/sessions
         """
-        page = response.meta["playwright_page"]
-        sessions_url = page.url
-        session_xpath = "//img[contains(@class, 'chakra-image') and @alt]"
-        await page.screenshot(path=self.get_screenshot_name(response))
-        middle_of_page_xpath = "//main/div/div[2]/div[2]"
-        self.logger.info("Click middle of page")
-        await page.wait_for_selector(middle_of_page_xpath)
-        await page.click(middle_of_page_xpath)
-        await self.scroll_to_bottom(page, item_xpath=session_xpath, min_items=int(n_sessions_expected*grace_factor))
-        session_elements = await page.query_selector_all(session_xpath) # "xpath=//main//a"
-        # Loop over each poster on the fully loaded event page
-        session_links = await page.query_selector_all("xpath=//main/div/div[2]//a[not(@target='blank') and not(@target='_blank')]")
-        session_urls = [urljoin(page.url, await (link := p.get_attribute('href'))) for p in session_links]
-        self.logger.info(f"{len(session_elements)} elements, {len(session_urls)} links")
+        async with self.leased_page(response) as page:
+            if self.logged_out(page):
+                for request in self.relogin(response):
+                    yield request
+                return
+            await debug_screenshot(page, self.get_screenshot_name(response), self.settings)
+            session_urls = []
+            lectures = {}
+            async for session_url, _ in harvest_links(
+                page, self.session_link_selector,
+                min_items=int(n_sessions_expected*grace_factor),
+                focus_selector=self.sessions_focus_selector,
+            ):
+                session_urls.append(session_url)
+                if self.crawl_state.is_done(session_url):
+                    continue
+                if (item := await self.listing_item(page, session_url, lectures)) is not None:
+                    yield self.scraped(item, session_url, kind="session")
+                else:
+                    yield self.poster_request(session_url, len(session_urls), kind="session")
         self.logger.info(f"Identified {len(session_urls)} sessions by their link")
-        self.logger.info(f"Identified {len(session_elements)} elements to scrape")
-        for i, (session_element, session_url) in enumerate(zip(session_elements, session_urls)):
-            if i < 466:
-                continue
-            self.logger.info(f"Scraping session: {i} at {session_url}")
-            # await page.screenshot(path=f"poster-{i}-before.png")
-            # await page.goto(poster_url, wait_until="networkidle")
-            # await wait_idle_then_sleep(page, sleep=2.)
-            # await page.screenshot(path=f"poster-{i}.png")
-            #self.logger.warning(await page.content())
-            # Wait for the specific poster element using its index before fetching it
-            self.logger.info(f"Check if session {session_url} scraped already")
-            if in_csv(session_url, csv="./scraped-sessions.csv"):
-                self.logger.info(f"Already scraped {session_url}, skipping...")
-                continue
-            try:
-                self.logger.info("Click middle of page")
-                await page.wait_for_selector(middle_of_page_xpath)
-                await page.click(middle_of_page_xpath)
-                self.logger.info(f"Waiting for selector for session {i} to appear")
-                await self.scroll_to_bottom(page, item_xpath=session_xpath, min_items=int(n_sessions_expected*grace_factor))
-                session_element = await page.wait_for_selector(f"({session_xpath})[{i+1}]", timeout=20_000)
-            except (TimeoutError, playwright._impl._api_types.TimeoutError):
-                self.logger.warning(f"Session element {i} not found after waiting")
-                # Log the page content for debugging purposes
-                await page.screenshot(path=f"no_selector_sessions_{i}.png")
-                #self.logger.info(f"Page content: {await page.content()}")
-                #await page.go_back()
-                self.logger.warning(f"Going back to sessions page: {sessions_url}")
-                await page.goto(sessions_url)
-                await wait_idle_then_sleep(page, sleep=3.)
-                await self.scroll_to_bottom(
-                    page,
-                    item_xpath=sessions_xpath,
-                    min_items=int(n_sessions_expected*grace_factor)
-                )
-                await page.screenshot(path="except_sessions.png")
-                continue
-            else:
-                self.logger.info("Selector appeared, click")
-
-            #Click on the session link and navigate to the session page
-            ixx = 0
-            while page.url != session_url:
-                self.logger.warning(f"({ixx} click attempts) Page URL {page.url} != Session URL {session_url}")
-                try:
-                    session_element = await page.wait_for_selector(f"({session_xpath})[{i+1}]", timeout=20_000)
-                    await click_with_retry(session_element, self.logger)
-                except Exception as e:
-                    self.logger.exception(e)
-                    self.logger.error(f"Failed to click through to page {session_url}")
-                    with open("./failed-sessions.log", "a") as fp:
-                        fp.write(page.url + "\n")
+        self.crawl_state.save_listing(self.sessions_url, session_urls)
+        self.queued_listings.add(self.sessions_url)
+
+    async def collect_posters(self, response):
+        """
+        Visit every event of the posters page in turn and scroll its poster list to the
+        end, fanning out a request per poster as soon as its link appears. Fully loaded
+        listings are saved, so an interrupted crawl doesn't have to scroll them again, and
+        events whose saved listing was queued by listing_requests are skipped.
+        """
+        n_posters = 0
+        async with self.leased_page(response) as page:
+            if self.logged_out(page):
+                for request in self.relogin(response):
+                    yield request
+                return
+            await debug_screenshot(page, self.get_screenshot_name(response), self.settings)
+            events = self.crawl_state.listing(self.posters_url)
+            if events is None:
+                self.logger.info("Scroll to bottom to load all events")
+                events = [e async for e in harvest_links(page, self.events_selector)]
+                self.crawl_state.save_listing(self.posters_url, events)
+            self.logger.info(f"Identified {len(events)} events to scrape")
+            for i_e, (event_url, event_text) in enumerate(events):
+                if event_url in self.queued_listings:
+                    self.logger.info(f"Posters of event {i_e+1}/{len(events)} already queued")
                     continue
-                await wait_idle_then_sleep(page, sleep=3.)
-                ixx += 1
-                if ixx >= 20:
-                    raise Exception
-
-            # Scrape an item from the poster page using a callback
-            #ix = 1 
-            ixx = 0
+                if self.crawl_state.listing(event_url) is not None:
+                    self.logger.info(f"Using saved poster list of event {i_e+1}/{len(events)}")
+                    for request in self.saved_listing_requests(event_url):
+                        n_posters += 1
+                        yield request
+                else:
+                    self.logger.info(f"Collecting posters of event {i_e+1}/{len(events)} at {event_url}")
+                    # "View XXX posters"
+                    n_posters_expected = int(re.match(".*\s(?P<n_posters>\d+)\s.*", event_text).group("n_posters"))
+                    self.logger.info(f"Button indicates {n_posters_expected} posters expected")
+                    await page.goto(event_url)
+                    # make sure at least 95% of the reported abstracts are there (sometimes the number doesn't
+                    # match what's indicated on the button exactly) before terminating scroll
+                    poster_urls = []
+                    lectures = {}
+                    async for poster_url, _ in harvest_links(page, self.poster_link_selector, min_items=int(n_posters_expected*0.95)):
+                        poster_urls.append(poster_url)
+                        if self.crawl_state.is_done(poster_url):
+                            continue
+                        if (item := await self.listing_item(page, poster_url, lectures)) is not None:
+                            yield self.scraped(item, poster_url, kind="poster")
+                        else:
+                            yield self.poster_request(poster_url, n_posters)
+                            n_posters += 1
+                    self.logger.info(f"Identified {len(poster_urls)} posters by their link")
+                    self.crawl_state.save_listing(event_url, poster_urls)
+                    self.queued_listings.add(event_url)
+        self.logger.info(f"Queued {n_posters} posters")
+
+    async def parse_poster_page(self, response):
+        kind = response.meta["kind"]
+        n_items = 0
+        async with self.leased_page(response) as page:
             try:
-                self.logger.info("Parsing session page")
-                async for item in self.parse_poster(page):
-                    yield item
-                self.logger.info("Write to CSV")
-                write_to_csv(session_url, csv="./scraped-sessions.csv")
+                if self.logged_out(page):
+                    # not parsed, retried once logged in again
+                    for request in self.relogin(response):
+                        yield request
+                    return
+                if self.settings.getbool("AAAI_API_CAPTURE"):
+                    if (item := await self.detail_item(page, response.url)) is not None:
+                        n_items += 1
+                        yield self.scraped(item, response.url, kind=kind)
+                if not n_items:
+                    async for item in async_iterator_with_timeout(self.parse_poster(page), 90., logger=self.logger):
+                        n_items += 1
+                        yield self.scraped(item, response.url, kind=kind)
+                if not n_items and (retry := self.retry(response.url, kind, "timed out")) is not None:
+                    yield retry
             except Exception as e:
                 self.logger.error(f"Failed to parse item at {page.url}")
-                with open("./failed-sessions.log", "a") as fp:
-                    fp.write(page.url + "\n")
                 self.logger.error(e)
-            finally:
-                self.logger.info(f"Going back to sessions page: {sessions_url}")
-                ixx = 0
-                while page.url != sessions_url:
-                    await page.go_back()
-                    await wait_idle_then_sleep(page, sleep=3.)
-                    self.logger.warning(f"Page URL {page.url} != {sessions_url}")
-                    #await page.screenshot(path=f"while-{ixx}.png")
-                    ixx += 1
-                    if ixx >= 20:
-                        raise Exception
-                else:
-                    await wait_idle_then_sleep(page, sleep=3.)
-                    #await page.screenshot(path="finally.png")
-
-        await page.close()
-
-    async def open_events(self, response):
-        page = response.meta["playwright_page"]
-        await page.screenshot(path=self.get_screenshot_name(response))
-        
-        # loop over all buttons pointing to events
-        events_xpath = "//a[contains(@class, 'chakra-button')]"
-        event_elements = await page.query_selector_all(events_xpath)
-        self.logger.info(f"Identified {len(event_elements)} events to scrape")
-        for i_e, _ in enumerate(event_elements):
-            if i_e < 3:
-                continue
-            self.logger.info(f"At page URL: {page.url}")
-            #await page.reload()
-            await page.wait_for_load_state("networkidle")
-            self.logger.info("Scroll to bottom to load all events")
-            await self.scroll_to_bottom(page, item_xpath=events_xpath)
-            await page.screenshot(path=f"start-of-event-loop-{i_e}.png", full_page=True)
-            # Wait for the specific event element using its index before fetching it
-            try:
-                self.logger.info(f"Waiting for selector for event {i_e+1}/{len(event_elements)} to appear")
-                event_element = await page.wait_for_selector(f"({events_xpath})[{i_e+1}]", timeout=10_000)
-            except (TimeoutError, playwright._impl._api_types.TimeoutError):
-                self.logger.warning(f"Event {i_e+1}/{len(event_elements)} not found after waiting")
-                # Log the page content for debugging purposes
-                #self.logger.info(f"Page content: {await page.content()}")
-                await page.screenshot(path=f"wtf-{i_e}.png", full_page=True)
-                continue
-            
-            # Click on the event button and navigate to the event page
-            self.logger.info(f"Start scraping event: {event_element}")
-            event_text = await event_element.inner_text() # "View XXX posters"
-            n_posters_expected = int(re.match(".*\s(?P<n_posters>\d+)\s.*", event_text).group("n_posters"))
-            self.logger.info(f"Button indicates {n_posters_expected} posters expected")
-            await event_element.click()
-            ## ~~~~~ Inside event page ~~~~~~
-            await page.wait_for_load_state("networkidle")
-            
-            # Scroll down to load everything
-            # make sure at least 95% of the reported abstracts are there (sometimes the number doesn't
-            # match what's indicated on the button exactly) before terminating scroll
-            self.logger.info("Scroll to bottom to load posters")
-            poster_xpath = "//img[contains(@class, 'chakra-image') and @alt]"
-            await self.scroll_to_bottom(page, item_xpath=poster_xpath, min_items=int(n_posters_expected*0.95))
-            await page.screenshot(path=f"event_{i_e}.png")
-            event_url = page.url
-            self.logger.info(f"Event URL {event_url}") 
-            # Loop over each poster on the fully loaded event page
-            poster_elements = await page.query_selector_all(poster_xpath)
-            poster_links = await page.query_selector_all("xpath=//main//a")
-            poster_urls = [urljoin(page.url, await p.get_attribute('href')) for p in poster_links]
-            self.logger.info(f"Identified {len(poster_urls)} posters by their link")
-            # TODO
-            # Just use //a and following-sibling on a chakra-stack div to get all the poster links so don't have to keep scrolling.
-            self.logger.info(f"Identified {len(poster_elements)} posters to scrape")
-            for i, (poster_element, poster_url) in enumerate(zip(poster_elements, poster_urls)):
-                self.logger.info(f"Scraping poster: {i} at {poster_url}")
-                # await page.screenshot(path=f"poster-{i}-before.png")
-                # await page.goto(poster_url, wait_until="networkidle")
-                # await wait_idle_then_sleep(page, sleep=2.)
-                # await page.screenshot(path=f"poster-{i}.png")
-                #self.logger.warning(await page.content())
-                # Wait for the specific poster element using its index before fetching it
-                self.logger.info(f"Check if poster {poster_url} scraped already")
-                if in_csv(poster_url):
-                    self.logger.info(f"Already scraped {poster_url}, skipping...")
-                    continue
-                try:
-                    self.logger.info(f"Waiting for selector for poster {i} to appear")
-                    await self.scroll_to_bottom(page, item_xpath=poster_xpath, min_items=int(n_posters_expected*0.95))
-                    poster_element = await page.wait_for_selector(f"({poster_xpath})[{i+1}]", timeout=20_000)
-                except (TimeoutError, playwright._impl._api_types.TimeoutError):
-                    self.logger.warning(f"Poster element {i} not found after waiting")
-                    # Log the page content for debugging purposes
-                    await page.screenshot(path=f"no_selector_{i}.png")
-                    #self.logger.info(f"Page content: {await page.content()}")
-                    #await page.go_back()
-                    self.logger.warning(f"Going back to event {i_e} page: {event_url}")
-                    await page.goto(event_url)
-                    await wait_idle_then_sleep(page, sleep=3.)
-                    await self.scroll_to_bottom(page, item_xpath=poster_xpath, min_items=int(n_posters_expected*0.95))
-                    await page.screenshot(path="except.png")
-                    continue
-                else:
-                    self.logger.info("Selector appeared, click")
-
-                #Click on the poster link and navigate to the poster page
-                ixx = 0
-                while page.url != poster_url:
-                    self.logger.warning(f"({ixx} click attempts) Page URL {page.url} != Poster URL {poster_url}")
-                    await click_with_retry(poster_element, self.logger)
-                    await wait_idle_then_sleep(page, sleep=3.)
-                    ixx += 1
-                # Scrape an item from the poster page using a callback
-                #ix = 1 
-                try:
-                    self.logger.info("Parsing poster page")
-                    async for item in async_iterator_with_timeout(self.parse_poster(page), 90.):
-                        yield item
-                    self.logger.info("Write to CSV")
-                    write_to_csv(poster_url)
-                except Exception as e:
-                    self.logger.error(f"Failed to parse item at {page.url}")
-                    with open("./failed.log", "a") as fp:
-                        fp.write(page.url + "\n")
-                    self.logger.error(e)
-                finally:
-
-                    self.logger.info(f"Going back to event {i_e} page: {event_url}")
-                    ixx = 0
-                    while page.url != event_url:
-                        await page.go_back()
-                        await wait_idle_then_sleep(page, sleep=3.)
-                        self.logger.warning(f"Page URL {page.url} != {event_url}")
-                        await page.screenshot(path=f"while-{ixx}.png")
-                        ixx += 1
-                    else:
-                    #await page.goto(event_url)
-                    #await self.scroll_to_bottom(page, item_xpath=poster_xpath, min_items=int(n_posters_expected*0.95))
-                        await wait_idle_then_sleep(page, sleep=3.)
-                        await page.screenshot(path="finally.png")
-                    #continue
-                    #self.logger.info(f"parse poster iteration {ix} complete")
-                    #ix+=1
-
-                # # Return to the event page
-                # self.logger.info(f"Going back to event {i_e} page")
-                # await page.go_back()
-                # await wait_idle_then_sleep(page, sleep=3.)
-
-            # Return to the main events page
-            self.logger.info(f"Going back to main events page")
-            await page.goto(self.posters_url)#page.go_back()
-            await wait_idle_then_sleep(page, sleep=3.)
-        # Close the Playwright page
-        await page.close()
+                # not fit to be reused, whatever state it was left in
+                await pagepool.pool.discard(page)
+                if not n_items and (retry := self.retry(response.url, kind, repr(e))) is not None:
+                    yield retry
 
     def set_user_agent(self, request, response):
         request.headers['User-Agent'] = self.user_agent
         return request
 
-    async def parse_poster(self, page, sleep_switch_tabs=1.):
-        """Main scraping method, constructs and populates an item from a given poster page"""
-        # upon opening event page (response)
-        # Construct the item loader to collect for the scraped data
-        self.logger.info(f"Scraping poster basic info at {page.url}")
-        
-        item = AAAILoaderItem()
-        html = await page.content()
-        selector = Selector(text=html)
-        loader = ItemLoader(item=item,
-                            selector=selector)
-        # populate the basic fields here from the event splash page
+    async def parse_poster(self, page):
+        """Main scraping method, constructs and populates an item from a given poster page in a single page.evaluate"""
+        self.logger.info(f"Scraping poster at {page.url}")
+        key = site_key(page.url, "abstract_tab")
+        start = time.perf_counter()
+        fields = await page.evaluate(EXTRACT_POSTER_JS, timeouts.timeout(key) * 1000)
+        latency = time.perf_counter() - start
+        self.crawler.stats.inc_value("aaai/extract_count")
+        self.crawler.stats.inc_value("aaai/extract_time", latency, start=0.)
+        self.crawler.stats.max_value("aaai/extract_latency_max", latency)
+        self.logger.info(f"Extracted poster in {latency * 1000:.0f}ms")
+        if fields["abstract_ms"] is not None:
+            timeouts.observe(key, fields["abstract_ms"] / 1000)
+        elif fields["abstract_tab"]:
+            timeouts.missed(key)
+        if not fields["abstract"]:
+            self.logger.warning("No abstract found")
+        loader = ItemLoader(item=AAAILoaderItem())
         loader.add_value("url", page.url)
         loader.add_value("conference", self.conference)
         loader.add_value("year", self.year)
-        title = page.locator("//h1").last
-        loader.add_value("title", await title.inner_text())
-        authors = await title.locator("xpath=./following-sibling::div").inner_text()
-        loader.add_value("authors", authors)
-        # -- open individual tabs and continue scraping
-        # scrape abstract (passing the item loader on in the metadata)
-        self.logger.info("Opening abstract tab")
-        buttons = page.get_by_role("button")
-        abstract_text = page.get_by_text("Abstract")#re.compile("\s+?abstract\s+?", re.IGNORECASE))
-        abstract_button = page.locator("button:text('Abstract')")
-        if abstract_button is not None:
-            await abstract_button.hover()
-            await asyncio.sleep(sleep_switch_tabs)
-            await abstract_button.click()
-            await asyncio.sleep(sleep_switch_tabs)
-            await page.wait_for_load_state("networkidle")
-            self.logger.info("Extract abstract text")
-            # self.logger.warning(await page.locator("//div[@role='tabpanel']//p").all_inner_texts())
-            loader.add_value("abstract", " ".join(await page.locator("//div[@role='tabpanel']//p").all_inner_texts()))
-        else:
-            self.logger.warning("No abstract found")
-            loader.add_value("abstract", "")
-        # scrape poster content
-        self.logger.info("Opening poster tab")
-        # scrape poster info here
-        # poster_button = page.locator("button:text('poster')")
-        # if poster_button is not None:
-        #     await poster_button.hover()
-        #     await asyncio.sleep(sleep_switch_tabs)
-        #     await poster_button.click()
-        #     await asyncio.sleep(sleep_switch_tabs)
-        #     await page.wait_for_load_state("networkidle")
-        #     self.logger.info("Extracting poster content")
-        loader.selector = (selector := Selector(text=await page.content()))
-        slides_url = selector.xpath("//a[contains(text(), 'Download') and @download='slides']/@href").get()
-        paper_url = selector.xpath("//a[contains(text(), 'Download') and @download='paper']/@href").get()
-        loader.add_value("paper_url", urljoin(page.url, paper_url))
-        loader.add_value("slides_url", urljoin(page.url, slides_url))
+        for field in ("title", "authors", "abstract", "paper_url", "slides_url"):
+            loader.add_value(field, fields[field])
         item = loader.load_item()
         self.logger.debug("Scraped item:")
         self.logger.debug(item)
         yield item
-
-
-
-
-    
-    
\ No newline at end of file
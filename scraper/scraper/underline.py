@@ -0,0 +1,162 @@
+"""
+underline.py
+
+Poster and session data of underline.io from the JSON its single page app loads, so
+that items can be built from the API payloads a page fetches anyway instead of clicking
+through its tabs and parsing the rendered DOM.
+
+The API isn't documented, so payloads are searched for anything that looks like a
+lecture (a title plus authors or an abstract), JSON:API style `attributes` are flattened
+and keys are mapped tolerantly. Lectures are matched to poster/session pages by the
+numeric id at the start of the last segment of their url.
+"""
+import logging
+import re
+import typing as ty
+from urllib.parse import urljoin, urlparse
+
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("title", "authors", "abstract")
+
+TITLE_KEYS = ("title", "name")
+AUTHOR_KEYS = ("authors", "speakers", "presenters", "people")
+ABSTRACT_KEYS = ("abstract", "description", "summary")
+KEYWORD_KEYS = ("keywords", "tags", "topics")
+PAPER_KEYS = ("paperUrl", "paper_url", "paper", "pdfUrl", "pdf_url")
+SLIDES_KEYS = ("slidesUrl", "slides_url", "slides")
+
+
+def lecture_id(url: str) -> ty.Optional[str]:
+    """Id of a poster/session page, e.g. 42 for .../poster/42-some-title"""
+    segments = [s for s in urlparse(url).path.split("/") if s]
+    if not segments:
+        return None
+    match = re.match(r"\d+", segments[-1])
+    return match.group() if match else None
+
+
+def _first(entry: ty.Dict[str, ty.Any], keys: ty.Sequence[str]) -> ty.Any:
+    for key in keys:
+        if entry.get(key) not in (None, "", []):
+            return entry[key]
+    return None
+
+
+def _flatten(entry: ty.Dict[str, ty.Any]) -> ty.Dict[str, ty.Any]:
+    """JSON:API resources keep their fields under `attributes`"""
+    if isinstance(entry.get("attributes"), dict):
+        return {"id": entry.get("id"), "type": entry.get("type"), **entry["attributes"]}
+    return entry
+
+
+def _name(person: ty.Any) -> ty.Optional[str]:
+    if isinstance(person, str):
+        return person
+    if not isinstance(person, dict):
+        return None
+    person = _flatten(person)
+    name = _first(person, ("fullName", "full_name", "name", "displayName"))
+    if name is None:
+        name = " ".join(p for p in (person.get("firstName"), person.get("lastName")) if p) or None
+    return name
+
+
+def _text(value: ty.Any) -> ty.Optional[str]:
+    if isinstance(value, dict):
+        value = _first(value, ("text", "name", "value", "title"))
+    return value if isinstance(value, str) else None
+
+
+def _url(value: ty.Any, base_url: str) -> ty.Optional[str]:
+    value = _text(value) if isinstance(value, dict) else value
+    if not isinstance(value, str) or not value:
+        return None
+    return urljoin(base_url, value)
+
+
+def looks_like_lecture(entry: ty.Dict[str, ty.Any]) -> bool:
+    return _first(entry, TITLE_KEYS) is not None and (
+        _first(entry, AUTHOR_KEYS) is not None or _first(entry, ABSTRACT_KEYS) is not None
+    )
+
+
+def iter_lectures(payload: ty.Any) -> ty.Iterator[ty.Dict[str, ty.Any]]:
+    """Every object in `payload` that looks like a lecture, with its attributes flattened"""
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict):
+            entry = _flatten(node)
+            if looks_like_lecture(entry):
+                yield entry
+            stack.extend(v for v in entry.values() if isinstance(v, (dict, list)))
+
+
+def lecture_fields(entry: ty.Dict[str, ty.Any], base_url: str) -> ty.Dict[str, ty.Any]:
+    """AAAILoaderItem values found in a lecture, missing fields are left out"""
+    fields = {}
+    if (title := _text(_first(entry, TITLE_KEYS))) is not None:
+        fields["title"] = title
+    authors = _first(entry, AUTHOR_KEYS)
+    if isinstance(authors, (list, dict)):
+        # JSON:API relationships nest their list under `data`
+        authors = authors.get("data", []) if isinstance(authors, dict) else authors
+        if names := [n for n in map(_name, authors) if n]:
+            fields["authors"] = names
+    elif isinstance(authors, str):
+        fields["authors"] = [a for a in re.split(r"\s*[,;]\s*", authors) if a]
+    if (abstract := _text(_first(entry, ABSTRACT_KEYS))) is not None:
+        fields["abstract"] = abstract
+    keywords = _first(entry, KEYWORD_KEYS)
+    if isinstance(keywords, list):
+        if keywords := [k for k in map(_text, keywords) if k]:
+            fields["keywords"] = keywords
+    if (paper_url := _url(_first(entry, PAPER_KEYS), base_url)) is not None:
+        fields["paper_url"] = paper_url
+    if (slides_url := _url(_first(entry, SLIDES_KEYS), base_url)) is not None:
+        fields["slides_url"] = slides_url
+    return fields
+
+
+def is_complete(fields: ty.Dict[str, ty.Any]) -> bool:
+    return all(fields.get(f) for f in REQUIRED_FIELDS)
+
+
+def index_lectures(payloads: ty.Iterable[ty.Any], base_url: str) -> ty.Dict[str, ty.Dict[str, ty.Any]]:
+    """
+    Lecture id -> item fields of every lecture in `payloads`. A lecture seen in several
+    payloads (e.g. a listing and its detail) keeps the fields of each.
+    """
+    lectures: ty.Dict[str, ty.Dict[str, ty.Any]] = {}
+    for payload in payloads:
+        for entry in iter_lectures(payload):
+            if entry.get("id") is None:
+                continue
+            fields = lecture_fields(entry, base_url)
+            lectures.setdefault(str(entry["id"]), {}).update(fields)
+    return lectures
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    detail = {
+        "data": {
+            "id": "42", "type": "lectures",
+            "attributes": {"title": "A poster", "description": "What it's about", "tags": [{"name": "ML: Vision"}]},
+        },
+        "included": [{"id": "7", "type": "lectures", "attributes": {"name": "Another", "speakers": ["A B"]}}],
+    }
+    listing = [{"id": 42, "title": "A poster", "speakers": [{"firstName": "Ada", "lastName": "Lovelace"}],
+                "slidesUrl": "/slides/42.pdf"}]
+    lectures = index_lectures([listing, detail], "https://underline.io/events/380/posters/1/poster/42-a-poster")
+    assert lecture_id("https://underline.io/events/380/posters/1/poster/42-a-poster") == "42"
+    assert is_complete(lectures["42"]), lectures["42"]
+    assert lectures["42"]["authors"] == ["Ada Lovelace"]
+    assert lectures["42"]["keywords"] == ["ML: Vision"]
+    assert lectures["42"]["slides_url"] == "https://underline.io/slides/42.pdf"
+    assert not is_complete(lectures["7"])
+    logger.info(lectures)
@@ -0,0 +1,70 @@
+"""
+virtualsite.py
+
+Helpers for the miniconf "virtual site" of ICML/NeurIPS, which publishes every oral and
+poster in a static JSON file (e.g. /static/virtual/data/neurips-2022-orals-posters.json).
+Used as a fast path by the spiders so that event pages whose fields are missing from
+the plain html don't have to be rendered by Splash.
+"""
+import json
+import logging
+import typing as ty
+from urllib.parse import urljoin, urlparse
+
+import scrapy
+
+
+logger = logging.getLogger(__name__)
+
+# fields an item needs before it is yielded without rendering the page
+REQUIRED_FIELDS = ("title", "authors", "abstract")
+
+
+def event_key(url: str) -> str:
+    """Events are matched on the path of their page, e.g. /virtual/2022/poster/16232"""
+    return urlparse(url).path.rstrip("/")
+
+
+def is_complete(item: scrapy.Item, fields: ty.Sequence[str] = REQUIRED_FIELDS) -> bool:
+    return all(item.get(f) for f in fields)
+
+
+def parse_virtual_data(body: ty.Union[str, bytes], base_url: str) -> ty.Dict[str, ty.Dict[str, ty.Any]]:
+    """Index the entries of a virtual site data file by event_key of their page"""
+    data = json.loads(body)
+    entries = data.get("results", []) if isinstance(data, dict) else data
+    index = {}
+    for entry in entries:
+        url = entry.get("virtualsite_url") or entry.get("url")
+        if url:
+            index[event_key(urljoin(base_url, url))] = entry
+    logger.info(f"Loaded {len(index)} events from virtual site data")
+    return index
+
+
+def virtual_fields(entry: ty.Dict[str, ty.Any]) -> ty.Dict[str, ty.Any]:
+    """
+    Map a virtual site entry onto item fields. Key names vary between conferences and
+    years, so every field is optional and the first key present wins.
+    """
+    def first(*keys):
+        for k in keys:
+            if entry.get(k):
+                return entry[k]
+
+    authors = [
+        a.get("fullname") or a.get("name") if isinstance(a, dict) else a
+        for a in first("authors", "speakers") or []
+    ]
+    keywords = first("keywords") or []
+    if not keywords and first("topic"):
+        keywords = [first("topic")]
+    return {
+        "title": first("name", "title"),
+        "item_type": first("eventtype", "event_type", "type"),
+        "authors": [a for a in authors if a],
+        "abstract": first("abstract"),
+        "keywords": keywords,
+        "paper_url": first("paper_url", "paper_pdf_url"),
+        "openreview_url": first("sourceurl", "openreview_url"),
+    }
@@ -0,0 +1,189 @@
+"""
+waits.py
+
+Render waits on concrete readiness conditions (a selector is present, an element count
+has settled, the network is idle) instead of fixed sleeps, shared by the Splash Lua
+scripts and the Playwright spiders.
+
+Every condition gets a timeout learned per site from how long it took to be met on
+earlier pages: the p95 of the recent observations with some margin, capped, and a
+default until enough pages have been seen. So a page never waits longer than it needs
+to, and a condition that won't be met gives up after about as long as it usually takes.
+"""
+import asyncio
+import logging
+import math
+import time
+import typing as ty
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+from playwright.async_api import Page, TimeoutError as PlaywrightTimeoutError
+
+
+logger = logging.getLogger(__name__)
+
+
+class LearnedTimeouts:
+    """Per site/condition readiness times, and timeouts derived from them"""
+
+    def __init__(self, default: float = 10., cap: float = 30., floor: float = 0.5, margin: float = 1.5,
+                 quantile: float = 0.95, window: int = 200, min_samples: int = 10):
+        self.default = default
+        self.cap = cap
+        self.floor = floor
+        self.margin = margin
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.timeouts_hit = defaultdict(int)
+
+    def observe(self, key: str, seconds: float):
+        self.samples[key].append(seconds)
+
+    def missed(self, key: str):
+        self.timeouts_hit[key] += 1
+
+    def quantile_of(self, key: str) -> ty.Optional[float]:
+        samples = sorted(self.samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(self.quantile * len(samples)) - 1)]
+
+    def timeout(self, key: str, cap: ty.Optional[float] = None) -> float:
+        """Seconds to wait for `key` before giving up"""
+        cap = self.cap if cap is None else cap
+        q = self.quantile_of(key)
+        if q is None:
+            return min(self.default, cap)
+        return min(max(q * self.margin, self.floor), cap)
+
+    def stats(self) -> ty.Dict[str, ty.Dict[str, float]]:
+        return {
+            key: {
+                "samples": len(samples),
+                "timeout": self.timeout(key),
+                "timeouts_hit": self.timeouts_hit[key],
+            }
+            for key, samples in self.samples.items()
+        }
+
+
+# shared by every spider in the process
+timeouts = LearnedTimeouts()
+
+
+def site_key(url: str, condition: str) -> str:
+    return f"{urlparse(url).netloc}:{condition}"
+
+
+async def _timed(key: str, awaitable) -> ty.Optional[float]:
+    start = time.perf_counter()
+    try:
+        await awaitable
+    except PlaywrightTimeoutError:
+        timeouts.missed(key)
+        logger.debug(f"Gave up waiting for {key}")
+        return None
+    elapsed = time.perf_counter() - start
+    timeouts.observe(key, elapsed)
+    return elapsed
+
+
+async def wait_for_selector(page: Page, selector: str, condition: ty.Optional[str] = None,
+                            state: str = "visible") -> ty.Optional[float]:
+    """Wait until `selector` is in the page, returns the seconds waited or None on timeout"""
+    key = site_key(page.url, condition or selector)
+    return await _timed(key, page.wait_for_selector(selector, state=state, timeout=timeouts.timeout(key) * 1000))
+
+
+async def wait_network_idle(page: Page, condition: str = "networkidle") -> ty.Optional[float]:
+    key = site_key(page.url, condition)
+    return await _timed(key, page.wait_for_load_state("networkidle", timeout=timeouts.timeout(key) * 1000))
+
+
+async def wait_count_changed(page: Page, selector: str, previous: int, condition: ty.Optional[str] = None,
+                             poll: float = 0.1) -> int:
+    """
+    Poll the number of elements matching `selector` until it differs from `previous`,
+    e.g. after scrolling an infinite list. Returns the latest count, which is
+    `previous` if nothing changed in time.
+    """
+    key = site_key(page.url, condition or f"count:{selector}")
+    deadline = timeouts.timeout(key)
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < deadline:
+        count = len(await page.query_selector_all(selector))
+        if count != previous:
+            timeouts.observe(key, elapsed)
+            return count
+        await asyncio.sleep(poll)
+    timeouts.missed(key)
+    return previous
+
+
+async def wait_count_stable(page: Page, selector: str, min_count: int = 0, checks: int = 2,
+                            condition: ty.Optional[str] = None, poll: float = 0.1) -> int:
+    """
+    Wait until at least `min_count` elements match `selector` and their number hasn't
+    moved for `checks` consecutive polls `poll` seconds apart. The learned timeout only
+    bounds the wait, a count that has settled already returns after `checks` polls.
+    """
+    key = site_key(page.url, condition or f"stable:{selector}")
+    deadline = timeouts.timeout(key)
+    start = time.perf_counter()
+    count = len(await page.query_selector_all(selector))
+    stable = 0
+    while time.perf_counter() - start < deadline:
+        await asyncio.sleep(poll)
+        new_count = len(await page.query_selector_all(selector))
+        stable = stable + 1 if new_count == count else 0
+        count = new_count
+        if stable >= checks and count >= min_count:
+            timeouts.observe(key, time.perf_counter() - start)
+            return count
+    timeouts.missed(key)
+    if count < min_count:
+        logger.warning(f"Element count settled at {count} < {min_count} for {selector}")
+    return count
+
+
+async def wait_ready(page: Page, selector: ty.Optional[str] = None, network_idle: bool = True) -> bool:
+    """Network idle and/or `selector` present, returns whether everything was ready in time"""
+    ready = True
+    if network_idle:
+        ready = await wait_network_idle(page) is not None
+    if selector is not None:
+        ready = await wait_for_selector(page, selector) is not None and ready
+    return ready
+
+
+# Splash: wait_for(splash, selector, timeout) polls for `selector` and returns the seconds
+# it took, or nil on timeout. Scripts report these back (e.g. as `ready_ms`) and the
+# spider feeds them to observe_splash
+splash_wait_for_lua = """
+function wait_for(splash, selector, timeout, step)
+  step = step or 0.1
+  local waited = 0
+  while not splash:select(selector) do
+    if waited >= timeout then
+      return nil
+    end
+    assert(splash:wait(step))
+    waited = waited + step
+  end
+  return waited
+end
+"""
+
+
+def observe_splash(response, condition: str, field: str = "ready_ms"):
+    """Record the readiness time a Splash script returned, None means it timed out"""
+    data = getattr(response, "data", None)
+    if not isinstance(data, dict):
+        return
+    key = site_key(response.url, condition)
+    if data.get(field) is None:
+        timeouts.missed(key)
+    else:
+        timeouts.observe(key, data[field] / 1000)